@@ -1,13 +1,16 @@
 import psycopg2
 import csv
 import pandas as pd
-import numpy as np
 import multiprocessing as mp
-from psycopg2.extras import execute_batch
 import os, zipfile
 import glob
 import random
 from sqlalchemy import create_engine
+import sys
+sys.path.append('..')
+from citibike_telemetry import telemetry
+from citibike_copy import copy_ingest
+from citibike_functions import inventory_timestamps
 
 def execute_query(query):
     '''
@@ -52,15 +55,58 @@ def remove_numeric(series):
     A funtion that utilizes the pandas functionality of identifying 
     numeric strings. The tilde denotes that True values will be null.
     '''
-    num_check = series.str.isnumeric()
+    num_check = series.str.isnumeric().fillna(False).astype(bool)
     series = series.where(~num_check)
     return series
 
+def create_indexes(table, columns):
+    '''
+    Creates the indexes of a table once the bulk load is finished, maintaining
+    them during the load would slow down every COPY. Each entry of columns is a
+    column name or a tuple of column names for a composite index.
+    '''
+    for cols in columns:
+        if isinstance(cols, str):
+            cols = (cols,)
+        index_name = '{}_{}_idx'.format(table.split('.')[-1], '_'.join(cols)).lower()
+        execute_query("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(index_name, table, ", ".join(cols)))
+
+def clean_rider_chunk(chunk):
+    '''
+    Data was collected from csv files for each month from 2013 to 2021. The files are combined with
+    citibike_merge.py, which drops the embedded header lines and maps every schema to the canonical
+    columns, so the chunks no longer need to be scrubbed row by row. Numeric columns are coerced into
+    numeric format making values that are not able to be converted to numeric formats null.
+    The birth year column is filled with instances of "\n" which denotes that the birth year was not input
+    by the user, so these observations were filled with zero. Birth year and gender columns were also checked
+    for lengths and made null if they were not within the length constraints. In the case of gender, zero was
+    imputed (indicating unknown gender). 
+    '''
+    numeric_columns = ['tripduration', 'start station id','start station latitude', 'start station longitude','end station id',
+                    'end station latitude', 'end station longitude', 'bikeid', 'birth year', 'gender']
+    integer_columns = ['tripduration', 'start_station_id', 'end_station_id', 'bikeid', 'birth_year', 'gender']
+    n_rows = len(chunk)
+    # The string cast turns missing values into 'nan'/'NaT', they are kept missing so the fills and dropna below see them
+    chunk = chunk.astype(str).mask(chunk.isna())
+    chunk[numeric_columns] = chunk[numeric_columns].apply(pd.to_numeric, errors = 'coerce')
+    chunk['birth year'] = chunk['birth year'].fillna(0)
+    chunk['gender'] = chunk['gender'].fillna(0)
+    chunk.columns = pd.Series(chunk.columns).str.replace(" ", "_")
+    chunk[['starttime', 'stoptime']] = chunk[['starttime', 'stoptime']].apply(remove_numeric)
+    station_null_index = chunk[chunk.end_station_id.isna()].index
+    chunk.loc[station_null_index, ['end_station_id', 'end_station_latitude', 'end_station_longitude']] =\
+        chunk.loc[station_null_index, ['start_station_id', 'start_station_latitude', 'start_station_longitude']]
+    chunk['usertype'] = chunk['usertype'].fillna('Unknown')
+    chunk = chunk.dropna()
+    telemetry.drop('riders: null values', n_rows - len(chunk))
+    # COPY parses the csv text directly, so integer columns must not be written as floats (e.g. 72.0)
+    chunk = chunk.astype({col: 'int64' for col in integer_columns})
+    return chunk
+
 def df_to_sql():
-    conn = psycopg2.connect('dbname = citibike user = postgres password = ***')
-    cur = conn.cursor()
-    cur.execute("""
-             CREATE TABLE infrastructure.riders (
+    execute_query("""
+             CREATE TABLE IF NOT EXISTS infrastructure.riders (
+             ride_id BIGSERIAL PRIMARY KEY,
              tripduration INT8,
              starttime TIMESTAMP,
              stoptime TIMESTAMP,
@@ -79,56 +125,15 @@ def df_to_sql():
              );
             """)
     '''
-    Reads combined csv file of accumulated ride data in 20,000 interval chunks.
-    Date time format is inferred due to inconsistency in formatting. 
+    Reads combined csv file of accumulated ride data (written by citibike_merge.py) in 100,000 row chunks.
+    Date time format is inferred due to inconsistency in formatting. Each cleaned
+    chunk is loaded with COPY and committed separately, indexes are built at the end.
+    ride_id numbers the rides in load order, refresh_final_tables picks up new rides by it.
     '''
     rider_iter = pd.read_csv(r'E:\Citibike\rider.csv', 
                             chunksize = 100000, encoding = 'utf-8', parse_dates= ['starttime', 'stoptime'], infer_datetime_format= True)
-    numeric_columns = ['tripduration', 'start station id','start station latitude', 'start station longitude','end station id',
-                    'end station latitude', 'end station longitude', 'bikeid', 'birth year', 'gender']
-    for chunk in rider_iter:
-        '''
-        Data was collected from csv files for each month from 2013 to 2021. The files were combined using 
-        the command line. Consequentially, there are lines where headers still exist. To remove these lines,
-        the replace function is used to remove embedded header lines and make them null. Numeric lines are 
-        coerced into numeric format making lines that are not able to be converted to numeric formats null.
-        The birth year column is filled with instances of "\n" which denotes that the birth year was not input
-        by the user, so these observations were filled with zero. Birth year and gender columns were also checked
-        for lengths and made null if they were not within the length constraints. In the case of gender, zero was
-        imputed (indicating unknown gender). 
-        '''
-        chunk = chunk.apply(lambda x: x.astype(str).replace(x.name,np.nan),axis = 1)
-        chunk.loc[:, numeric_columns] = chunk.loc[:, numeric_columns].apply(lambda x: pd.to_numeric(x, errors = 'coerce'), axis = 1)
-        chunk['birth year'] = chunk['birth year'].fillna(0)
-        chunk['gender'] = chunk['gender'].fillna(0)
-        chunk.columns = pd.Series(chunk.columns).str.replace(" ", "_")
-        print('# of null values : {}'.format(chunk.isna().sum()))
-        chunk.loc[:, ['starttime', 'stoptime']] = chunk.loc[:, ['starttime', 'stoptime']].apply\
-            (lambda x: remove_numeric(x.astype(str)), axis = 1)
-        station_null_index = chunk[chunk.end_station_id.isna()].index
-        chunk.loc[station_null_index, ['end_station_id', 'end_station_latitude', 'end_station_longitude']] =\
-            chunk.loc[station_null_index, ['start_station_id', 'start_station_latitude', 'start_station_longitude']]
-        chunk['usertype'] = chunk['usertype'].fillna('Unknown')
-        chunk = chunk.dropna()
-        print(chunk.head())
-        if len(chunk) > 0:
-            '''
-            Creates a list of column names for dataframe and prepares an insert statement using %s
-            as value placeholders for the number of columns in each row. The INSERT statement is executed
-            using the execute_batch command in the psycopg2 extras module
-            '''
-            df_columns = list(chunk)
-            # create (col1,col2,...)
-            columns = ", ".join(df_columns)
-
-            # create VALUES('%s', '%s",...) one '%s' per column
-            values = "VALUES({})".format(", ".join(["%s" for _ in df_columns])) 
-
-            #create INSERT INTO table (columns) VALUES('%s',...)
-            insert_stmt = "INSERT INTO infrastructure.riders ({}) {}".format(columns,values)
-            psycopg2.extras.execute_batch(cur, insert_stmt, chunk.values)
-    conn.commit()
-    cur.close()    
+    copy_ingest(rider_iter, 'infrastructure.riders', clean_rider_chunk)
+    create_indexes('infrastructure.riders', ['starttime', 'start_station_id'])
     print('SQL Insert Complete')
 df_to_sql()
    
@@ -188,10 +193,23 @@ combined_csv = pd.concat([pd.read_csv(f) for f in all_filenames ])
 #export to csv
 combined_csv.to_csv( r"C:\Users\mmotd\OneDrive\Documents\Citibike\Stations\inventory.csv", index=False) # Combining csv from directory into singular csv file
 
+INVENTORY_COLUMNS = ['dock_id', 'dock_name', 'date', 'hour', 'minute', 'pm', 'avail_bikes', 'avail_docks', 'tot_docks', '_lat', '_long', 'in_service', 'status_key']
+
+def split_inventory_chunk(chunk):
+    # Split dataframe into multiple columns and save that to a new temporary dataframe
+    chunk = chunk.iloc[:,0].astype(str).str.split("\t", expand = True)
+    if len(chunk.columns) != 13:
+        telemetry.drop('inventory: wrong number of columns', len(chunk))
+        return chunk.iloc[0:0]
+    # Assign the list of columns to be used
+    chunk.columns = INVENTORY_COLUMNS
+    return chunk
+
 def inventory_process():
     
     execute_query(""" 
-        CREATE TABLE infrastructure.inventory (
+        CREATE TABLE IF NOT EXISTS infrastructure.inventory (
+            row_id BIGSERIAL PRIMARY KEY,
             dock_id TEXT, 
             dock_name TEXT, 
             date TEXT, 
@@ -207,35 +225,14 @@ def inventory_process():
             status_key TEXT
         );            
         """)
-    conn = psycopg2.connect('dbname = citibike user = postgres password = ***')
-    cur = conn.cursor()
     inventory = pd.read_csv(r"E:\Citibike\Stations\inventory.csv",
                         error_bad_lines = False, warn_bad_lines= True, chunksize = 100000)
-
-    for chunk in inventory:
-        # Split dataframe into multiple columns and save that to a new temporary dataframe
-        # Generate the list of columns to be used
-        # Split dataframe into multiple columns and save that to a new temporary dataframe
-        chunk = chunk.iloc[:,0].astype(str).str.split("\t", expand = True)
-        print(chunk)
-        if len(chunk.columns) == 13:
-                chunk.columns = ['dock_id', 'dock_name', 'date', 'hour', 'minute', 'pm', 'avail_bikes', 'avail_docks', 'tot_docks', '_lat', '_long', 'in_service', 'status_key']
-                '''
-                Creates a list of column names for dataframe and prepares an insert statement using %s
-                as value placeholders for the number of columns in each row. The INSERT statement is executed
-                using the execute_batch command in the psycopg2 extras module
-                '''
-                df_columns = chunk.columns.astype(str)
-                columns = ", ".join(df_columns)
-                print(columns)
-                # create VALUES('%s', '%s",...) one '%s' per column
-                values = "VALUES({})".format(", ".join(["%s" for _ in df_columns]))
-                print(values)
-                #create INSERT INTO table (columns) VALUES('%s',...)
-                insert_stmt = "INSERT INTO infrastructure.inventory ({}) {}".format(columns,values)
-                psycopg2.extras.execute_batch(cur, insert_stmt, chunk.values)
-    conn.commit()
-    cur.close()    
+    '''
+    Chunks that do not split into the 13 inventory columns are skipped. Each chunk
+    is loaded with COPY and committed separately. row_id numbers the rows in load
+    order, it is the key inventory_clean resumes on.
+    '''
+    copy_ingest(inventory, 'infrastructure.inventory', split_inventory_chunk)
     print('SQL Insert Complete')
 
 inventory_process()
@@ -259,9 +256,10 @@ execute_query("""
             CREATE TABLE infrastructure_final.Stations 
                         (
                         station_name VARCHAR(60),
-                        station_id INT8,
+                        station_id INT8 PRIMARY KEY,
                         lat FLOAT4,
-                        lon FLOAT4
+                        lon FLOAT4,
+                        last_seen TIMESTAMP
                         );
 
             CREATE TABLE infrastructure_final.Inventory 
@@ -277,7 +275,41 @@ execute_query("""
               """)
 
 
-execute_query("""
+def refresh_final_tables():
+    '''
+    Incrementally refreshes Ride_Data and the Stations dimension from infrastructure.riders.
+    Only the rides loaded after the high-water mark (the last ride_id already processed) are
+    read through the ride_id primary key, so a monthly refresh does not scan the whole ride
+    history. Keying on the load order rather than on starttime also picks up backfilled or
+    late-loaded months and rides sharing the starttime of the previous mark. New station
+    ids are inserted and name/coordinate changes are taken from the latest ride of each
+    station, unless the station was already seen in a later ride (last_seen). The
+    high-water mark is advanced in the same transaction.
+    '''
+    conn = psycopg2.connect('dbname = citibike user = postgres password = ***')
+    cur = conn.cursor()
+    cur.execute("""
+            CREATE TABLE IF NOT EXISTS infrastructure_final.load_state (
+                        name TEXT PRIMARY KEY,
+                        high_water BIGINT
+                        );
+            INSERT INTO infrastructure_final.load_state VALUES ('riders', NULL)
+            ON CONFLICT (name) DO NOTHING;
+            """)
+    cur.execute("SELECT high_water FROM infrastructure_final.load_state WHERE name = 'riders' FOR UPDATE")
+    low = cur.fetchone()[0]
+    cur.execute("SELECT MAX(ride_id) FROM infrastructure.riders")
+    high = cur.fetchone()[0]
+    if high is None or (low is not None and high <= low):
+        conn.rollback()
+        conn.close()
+        print('No new rides')
+        return
+    new_rides = """
+            FROM infrastructure.riders
+            WHERE ride_id > COALESCE(%(low)s, 0) AND ride_id <= %(high)s
+            """
+    cur.execute("""
             INSERT INTO infrastructure_final.Ride_Data
             SELECT tripduration,
             starttime,
@@ -288,19 +320,31 @@ execute_query("""
             usertype,
             birth_year,
             gender 
-            FROM infrastructure.riders
-            """)
+            """ + new_rides, {'low': low, 'high': high})
+    print('{} rides added'.format(cur.rowcount))
+    cur.execute("""
+            INSERT INTO infrastructure_final.Stations (station_name, station_id, lat, lon, last_seen)
+                    SELECT DISTINCT ON (station_id) station_name, station_id, lat, lon, starttime
+                    FROM (
+                        SELECT start_station_name, start_station_id, start_station_latitude, start_station_longitude, starttime
+                        """ + new_rides + """
+                        UNION ALL
+                        SELECT end_station_name, end_station_id, end_station_latitude, end_station_longitude, starttime
+                        """ + new_rides + """
+                        ) AS station_rides (station_name, station_id, lat, lon, starttime)
+                    ORDER BY station_id, starttime DESC
+            ON CONFLICT (station_id) DO UPDATE
+                    SET station_name = EXCLUDED.station_name, lat = EXCLUDED.lat, lon = EXCLUDED.lon, last_seen = EXCLUDED.last_seen
+                    WHERE Stations.last_seen IS NULL OR EXCLUDED.last_seen > Stations.last_seen
+            """, {'low': low, 'high': high})
+    print('{} stations added or updated'.format(cur.rowcount))
+    cur.execute("UPDATE infrastructure_final.load_state SET high_water = %s WHERE name = 'riders'", (high,))
+    conn.commit()
+    cur.close()
+    conn.close()
+    create_indexes('infrastructure_final.Ride_Data', ['starttime', ('start_station_id', 'starttime'), 'end_station_id'])
 
-execute_query("""
-            INSERT INTO infrastructure_final.Stations
-                    SELECT 
-                        start_station_name AS station_name,
-                        start_station_id AS station_id,
-                        AVG(start_station_latitude) AS lat,
-                        AVG(start_station_longitude) AS lon
-                    FROM infrastructure.riders
-                    GROUP BY start_station_id, start_station_name
-            """)
+refresh_final_tables()
 date_df = pd.read_sql("""
                         SELECT 
                             dock_id, 
@@ -318,11 +362,41 @@ date_df = pd.read_sql("""
 for chunk in date_df:
     chunk.apply(lambda x: print(x.unique()))
 
-def inventory_clean():
-    conn = psycopg2.connect('dbname = citibike user = postgres password = ***')
-    cur = conn.cursor()
-    date_df = pd.read_sql("""
+def clean_inventory_chunk(chunk):
+    '''
+    Combining the separated date, hour, minute, and pm boolean columns into a single datetime object
+    '''
+    chunk.loc[:,['dock_id','avail_bikes', 'avail_docks', 'tot_docks', 'in_service', 'status_key']] =\
+    chunk.loc[:,['dock_id','avail_bikes', 'avail_docks', 'tot_docks', 'in_service', 'status_key']].apply(lambda x: x.replace('None', '0', regex = True), axis = 1)
+    chunk.loc[:,['dock_id','avail_bikes', 'avail_docks', 'tot_docks', 'in_service', 'status_key']] =\
+    chunk.loc[:,['dock_id','avail_bikes', 'avail_docks', 'tot_docks', 'in_service', 'status_key']].apply(lambda x: x.replace('\D', '', regex = True), axis = 1)
+    n_rows = len(chunk)
+    chunk = chunk.dropna() # There are large chunks of null values as a result of the csv concatenation
+    telemetry.drop('inventory: null values', n_rows - len(chunk))
+    chunk.loc[:,['avail_bikes', 'avail_docks', 'tot_docks']] =\
+    chunk.loc[:,['avail_bikes', 'avail_docks', 'tot_docks']].apply(lambda x: [0 if len(i) == 0 else i for i in x]) # Removes empty strings
+    # Timestamps are built from the year, month, day, hour, minute and pm numbers (12 AM is midnight, 12 PM is noon)
+    chunk['date'] = inventory_timestamps(chunk.date, chunk.hour, chunk.minute, chunk.pm)
+    n_rows = len(chunk)
+    chunk = chunk[chunk.date.notna()]
+    telemetry.drop('inventory: invalid date', n_rows - len(chunk))
+    n_rows = len(chunk)
+    chunk = chunk[chunk.dock_id != '']
+    telemetry.drop('inventory: empty dock_id', n_rows - len(chunk))
+    n_rows = len(chunk)
+    chunk = chunk[chunk.status_key != '']
+    telemetry.drop('inventory: empty status_key', n_rows - len(chunk))
+    final_df = chunk.loc[:, ['dock_id', 'date', 'avail_bikes', 'avail_docks', 'tot_docks', 'in_service', 'status_key']]
+    return final_df
+
+def inventory_chunks(last_row_id):
+    '''
+    Rows of infrastructure.inventory after last_row_id in row_id order. Postgres does
+    not guarantee the order of an unordered SELECT, so the load resumes on row_id.
+    '''
+    return pd.read_sql("""
                         SELECT 
+                            row_id,
                             dock_id, 
                             date, 
                             hour, 
@@ -334,45 +408,17 @@ def inventory_clean():
                             in_service, 
                             status_key
                         FROM infrastructure.inventory 
-                          """, dbConnection, chunksize = 1000000)
-    for chunk in date_df:
-
-        '''
-        Combining the separated date, hour, minute, and pm boolean columns into a single datetime object
-        '''
-        chunk.date = chunk.date.str.replace('"', '')
-        chunk['suffix'] = ['PM'if i == '1' else 'AM' for i in chunk.pm] # Conversion of boolean statement to AM or PM string
-        chunk.loc[:,['dock_id','avail_bikes', 'avail_docks', 'tot_docks', 'in_service', 'status_key']] =\
-        chunk.loc[:,['dock_id','avail_bikes', 'avail_docks', 'tot_docks', 'in_service', 'status_key']].apply(lambda x: x.replace('None', '0', regex = True), axis = 1)
-        chunk.loc[:,['dock_id','avail_bikes', 'avail_docks', 'tot_docks', 'in_service', 'status_key']] =\
-        chunk.loc[:,['dock_id','avail_bikes', 'avail_docks', 'tot_docks', 'in_service', 'status_key']].apply(lambda x: x.replace('\D', '', regex = True), axis = 1)
-        chunk = chunk.dropna() # There are large chunks of null values as a result of the csv concatenation
-        chunk.loc[:,['avail_bikes', 'avail_docks', 'tot_docks']] =\
-        chunk.loc[:,['avail_bikes', 'avail_docks', 'tot_docks']].apply(lambda x: [0 if len(i) == 0 else i for i in x]) # Removes empty strings
-        chunk['date'] = ['20' + i for i in chunk.date] # Inserting 20 in front of the date column
-        chunk['minute'] = ['0' + i if len(i) == 1 else i for i in chunk.minute] # Inserting a 0 in front of value if length equal to 1
-        chunk['date'] = chunk.date + ' ' + chunk.hour + ':' + chunk.minute + ' ' + chunk.suffix # Combining columns to form date string
-        chunk['date'] = pd.to_datetime(chunk.date, yearfirst=True) # Conversion to datetime object
-        chunk = chunk[chunk.dock_id != '']
-        chunk = chunk[chunk.status_key != '']
-        final_df = chunk.loc[:, ['dock_id', 'date', 'avail_bikes', 'avail_docks', 'tot_docks', 'in_service', 'status_key']]
-        print(final_df.head())
-        
-        '''
-        Creates a list of column names for dataframe and prepares an insert statement using %s
-        as value placeholders for the number of columns in each row. The INSERT statement is executed
-        using the execute_batch command in the psycopg2 extras module
-        '''
-        df_columns = final_df.columns
-        columns = ", ".join(df_columns)
-        # create VALUES('%s', '%s",...) one '%s' per column
-        values = "VALUES({})".format(", ".join(["%s" for _ in df_columns]))
-        print(values)
-        #create INSERT INTO table (columns) VALUES('%s',...)
-        insert_stmt = "INSERT INTO infrastructure_final.Inventory ({}) {}".format(columns,values)
-        psycopg2.extras.execute_batch(cur, insert_stmt, final_df.values)
-    conn.commit()
-    cur.close()    
+                        WHERE row_id > %(last_row_id)s
+                        ORDER BY row_id
+                          """, dbConnection, params = {'last_row_id': last_row_id or 0}, chunksize = 1000000)
+
+def inventory_clean():
+    '''
+    Each cleaned chunk is loaded with COPY and committed separately. The index on
+    dock and date is built once the load is finished.
+    '''
+    copy_ingest(inventory_chunks, 'infrastructure_final.Inventory', clean_inventory_chunk, key = 'row_id')
+    create_indexes('infrastructure_final.Inventory', [('dock_id', 'date')])
     print('SQL Insert Complete')
 inventory_clean()
 
@@ -0,0 +1,148 @@
+'''
+Pre-aggregated demand cube and cached rollups.
+
+Rides (or dock snapshots) are aggregated once into a cube at a fine grain
+(15 minutes by default) per station, cluster or status, keeping the sum and
+count of each value column. Hourly, daily and monthly sums, counts and means
+are rolled up from the cube instead of the raw rows. Cubes and rollups are
+cached on disk as parquet, keyed by a fingerprint of the source data, so
+repeating an analysis reads a small file instead of regrouping every row.
+'''
+# Import libraries
+import os
+import hashlib
+import pandas as pd
+from citibike_features import feature_engineering
+
+# Finest grain of the cube, every rollup frequency must be a multiple of it
+CUBE_FREQ = '15min'
+CACHE_DIR = '../data/cache'
+
+
+def fingerprint(source):
+    '''
+    Returns a fingerprint of the source data: the path, size and modification
+    time of a file (or list of files), or a hash of a dataframe's contents.
+    '''
+    digest = hashlib.sha1()
+    if isinstance(source, pd.DataFrame):
+        digest.update(str(list(source.columns)).encode())
+        digest.update(str(source.shape).encode())
+        digest.update(pd.util.hash_pandas_object(source, index = True).values.tobytes())
+    else:
+        paths = [source] if isinstance(source, str) else sorted(source)
+        for path in paths:
+            stat = os.stat(path)
+            digest.update('{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()[:16]
+
+
+def disk_cache(key, build, cache_dir = CACHE_DIR):
+    # Returns the cached dataframe for key, building and saving it on a cache miss
+    path = os.path.join(cache_dir, key + '.parquet')
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    df = build()
+    os.makedirs(cache_dir, exist_ok = True)
+    df.to_parquet(path)
+    return df
+
+
+def build_cube(df, values = (), by = (), freq = CUBE_FREQ, time_col = None):
+    '''
+    Aggregates df into freq buckets per combination of the by columns. The cube
+    has the row count of each cell ('rows') and the sum and non-null count of
+    each value column ('<value>_sum', '<value>_count'). The timestamps come from
+    the index, or from time_col if given.
+    '''
+    times = df.index if time_col is None else df[time_col]
+    buckets = pd.DatetimeIndex(times).floor(freq)
+    keys = [pd.Series(buckets, index = df.index, name = 'bucket')] + [df[col] for col in by]
+
+    grouped = df.groupby(keys, observed = True, sort = True)
+    cube = grouped.size().to_frame('rows')
+    for value in values:
+        cube[value + '_sum'] = grouped[value].sum()
+        cube[value + '_count'] = grouped[value].count()
+    return cube
+
+
+def cached_cube(source, values = (), by = (), freq = CUBE_FREQ, time_col = None, loader = None, cache_dir = CACHE_DIR,
+                source_key = None):
+    '''
+    Returns the cube of source from the disk cache, building it on a cache miss.
+    source is a file path (or list of paths) read with loader only when the
+    cube has to be built, or a dataframe. Hashing a large dataframe takes about
+    as long as grouping it, so pass a path, or the fingerprint of the dataframe
+    computed once as source_key, for the cache to pay off.
+    '''
+    key = 'cube-{}-{}'.format(source_key or fingerprint(source), hashlib.sha1(repr((tuple(values), tuple(by), freq, time_col)).encode()).hexdigest()[:8])
+
+    def build():
+        df = source if isinstance(source, pd.DataFrame) else loader(source)
+        return build_cube(df, values, by, freq, time_col)
+    return disk_cache(key, build, cache_dir)
+
+
+def rollup(cube, variable, frequency, by = None, agg = 'sum'):
+    '''
+    Rolls the cube up to frequency (e.g. 'H', 'd', 'm'), optionally per one or
+    more of the cube's group columns. agg is 'sum', 'count' or 'mean' of variable,
+    or 'rows' for the number of rows.
+    '''
+    by = [] if by is None else [by] if isinstance(by, str) else list(by)
+    keys = [pd.Grouper(level = 'bucket', freq = frequency)] + [pd.Grouper(level = col) for col in by]
+    grouped = cube.groupby(keys, observed = True)
+
+    if agg == 'rows':
+        return grouped['rows'].sum()
+    if agg == 'sum':
+        return grouped[variable + '_sum'].sum().rename(variable)
+    if agg == 'count':
+        return grouped[variable + '_count'].sum().rename(variable)
+    if agg == 'mean':
+        sums = grouped[[variable + '_sum', variable + '_count']].sum()
+        return (sums[variable + '_sum'] / sums[variable + '_count']).rename(variable)
+    raise ValueError('Unknown aggregation: {}'.format(agg))
+
+
+def time_agg(source, variable, frequency, groupby, group_var, agg, loader = None, time_col = None, cache_dir = CACHE_DIR,
+             source_key = None):
+    '''
+    Rollup of variable with feature_engineering applied, cached on disk. source
+    is a dataframe indexed by time, or a file path (or list of paths) read with
+    loader on a cache miss only, see cached_cube for source_key. The time
+    column of the result is named time_col, or after the dataframe's index.
+    '''
+    if time_col is None:
+        time_col = (source.index.name if isinstance(source, pd.DataFrame) else None) or 'index'
+    source_key = source_key or fingerprint(source)
+    by = [group_var] if groupby else []
+
+    def build():
+        cube = cached_cube(source, [variable], by, loader = loader, cache_dir = cache_dir, source_key = source_key)
+        agg_df = pd.DataFrame(rollup(cube, variable, frequency, by, agg)).reset_index()
+        return agg_df.rename(columns = {'bucket': time_col})
+
+    key = 'rollup-{}-{}'.format(source_key, hashlib.sha1(repr((variable, frequency, tuple(by), agg, time_col)).encode()).hexdigest()[:8])
+    agg_df = disk_cache(key, build, cache_dir)
+    return feature_engineering(agg_df, time_col = time_col)
+
+
+def time_agg_sum(source, variable, frequency, groupby, group_var, loader = None, time_col = None, cache_dir = CACHE_DIR,
+                 source_key = None):
+    '''
+    Same result as time_agg_sum in the model notebooks (sum of variable per
+    frequency, or its count per frequency and group_var when groupby is True),
+    computed from the cached cube.
+    '''
+    agg = 'count' if groupby else 'sum'
+    return time_agg(source, variable, frequency, groupby, group_var, agg, loader, time_col, cache_dir, source_key)
+
+
+def time_agg_mean(source, variable, frequency, groupby, group_var, loader = None, time_col = None, cache_dir = CACHE_DIR,
+                  source_key = None):
+    '''
+    Same result as time_agg_mean in the model notebooks, computed from the cached cube.
+    '''
+    return time_agg(source, variable, frequency, groupby, group_var, 'mean', loader, time_col, cache_dir, source_key)
@@ -0,0 +1,96 @@
+'''
+Walk-forward backtesting of the ARIMA demand and dock status models.
+
+model_creation in the time series notebooks fits a new ARIMA on the whole
+history for every test step. Here the model is fitted once on the training
+part and its state is extended with each new observation, so a step costs one
+Kalman filter update instead of a full maximum likelihood fit. The parameters
+can optionally be re-estimated every refit_every steps (warm-started from the
+previous fit), and independent cluster/status series run in a process pool.
+'''
+# Import libraries
+import time
+import warnings
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.arima.model import ARIMA
+
+ORDER = (5, 1, 0)
+TRAIN_SIZE = 0.66
+
+
+def walk_forward(series, order = ORDER, train_size = TRAIN_SIZE, refit_every = None):
+    '''
+    Walk-forward validation of an ARIMA(order) model on series: the first
+    train_size of the values are the training set and every following value is
+    forecast one step ahead, then added to the model. With refit_every = k the
+    parameters are re-estimated on the full history every k steps (k = 1 matches
+    model_creation), otherwise they are kept from the training fit.
+    series can be a one-column dataframe, as in the notebooks.
+    Returns the fit on the full series, the predictions, the test values and the RMSE.
+    '''
+    X = np.asarray(series, dtype = float).ravel()
+    size = int(len(X) * train_size)
+    train, test = X[0:size], X[size:len(X)]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        fit = ARIMA(train, order = order).fit()
+        params = fit.params
+        step_fit = fit
+        predictions = np.empty(len(test))
+        for t in range(len(test)):
+            predictions[t] = step_fit.forecast()[0]
+            if refit_every and (t + 1) % refit_every == 0:
+                fit = ARIMA(X[0:size + t + 1], order = order).fit(start_params = params)
+                params = fit.params
+                step_fit = fit
+            else:
+                # Filters the new observation from the last state, the parameters are unchanged
+                step_fit = step_fit.extend(test[t:t + 1])
+
+        # Full sample results (residuals and summary) with the latest parameters
+        fit = ARIMA(X, order = order).filter(params)
+    rmse = np.sqrt(np.mean((test - predictions) ** 2))
+    return fit, predictions, test, rmse
+
+
+def model_creation(df, refit_every = None):
+    '''
+    Drop-in replacement of model_creation in the time series notebooks, returns
+    the fit, predictions, test values and residuals.
+    '''
+    demand_fit, predictions, test, rmse = walk_forward(df.values, refit_every = refit_every)
+    print('Test RMSE: %.3f' % rmse)
+    residuals = pd.DataFrame(demand_fit.resid)
+    print(demand_fit.summary())
+    print(residuals.describe())
+    return demand_fit, list(predictions), test, residuals
+
+
+def backtest_worker(args):
+    name, series, order, train_size, refit_every = args
+    start_time = time.time()
+    _, predictions, test, rmse = walk_forward(series, order, train_size, refit_every)
+    return name, predictions, test, rmse, time.time() - start_time
+
+
+def backtest(series, order = ORDER, train_size = TRAIN_SIZE, refit_every = None, processes = None):
+    '''
+    Backtests every series of a dict (or dataframe columns) of independent
+    series, e.g. one per cluster and status, with a pool of processes. Returns a
+    dataframe with the RMSE, number of test steps and wall time of each series,
+    and a dict of the predictions and test values of each series.
+    '''
+    items = series.items()
+    tasks = [(name, np.asarray(values, dtype = float).ravel(), order, train_size, refit_every) for name, values in items]
+
+    results = {}
+    rows = []
+    with mp.Pool(processes) as pool:
+        for name, predictions, test, rmse, seconds in pool.imap_unordered(backtest_worker, tasks):
+            results[name] = (predictions, test)
+            rows.append({'series': name, 'rmse': rmse, 'steps': len(test), 'seconds': seconds})
+            print('{}: Test RMSE: {:.3f} ({:.1f}s)'.format(name, rmse, seconds))
+    return pd.DataFrame(rows).set_index('series').sort_index(), results
@@ -0,0 +1,283 @@
+'''
+Benchmarks of the ingestion, cleaning and modeling hot paths.
+
+Synthetic data mimics the real inputs: the merged bikeshare_nyc_raw station
+files (tab separated, quoted names and dates, extra tab-packed fields, the
+header of every monthly file repeated inside the merged file, corrupted
+counts) and the combined trip csv (quoted and unquoted monthly files with
+their embedded headers). The synthetic files of a benchmark are written by
+one process and the benchmark runs in a fresh process, so its peak RSS does
+not include the data generation. The peak RSS of the process and its increase
+during the timed call are reported, and the results are written to a JSON
+report:
+
+    python citibike_benchmark.py --sizes 10000 100000 1000000 --out benchmark.json
+'''
+# Import libraries
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+SIZES = [10000, 100000]
+BENCHMARKS = ['process_stationdata', 'cleaning_stationdata', 'load_sqlite', 'distance_matrix', 'arima_backtest']
+YEAR = 2015
+
+# Header of the merged station files, the first 13 fields are used
+INVENTORY_HEADER = ['dock_id', 'dock_name', 'date', 'hour', 'minute', 'pm', 'avail_bikes', 'avail_docks',
+                    'tot_docks', '_lat', '_long', 'in_service', 'status_key']
+
+TRIP_HEADER = ['tripduration', 'starttime', 'stoptime', 'start station id', 'start station name',
+               'start station latitude', 'start station longitude', 'end station id', 'end station name',
+               'end station latitude', 'end station longitude', 'bikeid', 'usertype', 'birth year', 'gender']
+
+STREETS = ['W 52 St', 'Broadway', '8 Ave', 'E 14 St', 'Grove St PATH', 'Frederick Douglass Blvd', 'Pershing Square']
+AVENUES = ['11 Ave', 'W 117 St', 'W 31 St', 'E 17 St', 'Christopher St', 'Park Ave', 'Lafayette St']
+
+
+def station_table(n_stations, seed = 0):
+    # Station ids, names and coordinates around Manhattan
+    rng = np.random.default_rng(seed)
+    ids = np.sort(rng.choice(np.arange(72, 72 + n_stations * 10), n_stations, replace = False))
+    names = ['{} & {}'.format(STREETS[i % len(STREETS)], AVENUES[(i // len(STREETS)) % len(AVENUES)]) + ('' if i < 49 else ' {}'.format(i))
+             for i in range(n_stations)]
+    return pd.DataFrame({'station_id': ids, 'name': names,
+                         'latitude': 40.70 + rng.random(n_stations) * 0.12,
+                         'longitude': -74.02 + rng.random(n_stations) * 0.08})
+
+
+def embed_headers(lines, header, n_files):
+    # Repeats the header at the start of every monthly file, like cat *.csv > merged.csv
+    chunks = np.array_split(np.asarray(lines, dtype = object), n_files)
+    out = []
+    for chunk in chunks:
+        out.append(header)
+        out.extend(chunk.tolist())
+    return out
+
+
+def synthetic_inventory(path, n_rows, n_stations = 300, seed = 0):
+    '''
+    Writes a merged bikeshare_nyc_raw station file of n_rows snapshots: tab
+    separated fields, quoted dock names and dates, 12-hour clock with a pm flag,
+    about 1% of the lines with extra tab-packed fields, a few corrupted counts
+    and the header of each of the 12 monthly files inside the file.
+    '''
+    rng = np.random.default_rng(seed)
+    stations = station_table(n_stations, seed)
+    s = rng.integers(0, n_stations, n_rows)
+    days = pd.Timestamp('{}-03-01'.format(YEAR)) + pd.to_timedelta(np.sort(rng.integers(0, 365, n_rows)), unit = 'd')
+    tot_docks = rng.integers(15, 60, n_rows)
+    avail_bikes = rng.integers(0, tot_docks + 1)
+
+    fields = pd.DataFrame({'dock_id': stations['station_id'].to_numpy()[s].astype(str),
+                           'dock_name': '"' + stations['name'].to_numpy()[s].astype(object) + '"',
+                           'date': days.strftime('"%y-%m-%d"'),
+                           'hour': rng.integers(1, 13, n_rows).astype(str),
+                           'minute': rng.integers(0, 60, n_rows).astype(str),
+                           'pm': rng.integers(0, 2, n_rows).astype(str),
+                           'avail_bikes': avail_bikes.astype(str),
+                           'avail_docks': (tot_docks - avail_bikes).astype(str),
+                           'tot_docks': tot_docks.astype(str),
+                           '_lat': np.round(stations['latitude'].to_numpy()[s], 4).astype(str),
+                           '_long': np.round(stations['longitude'].to_numpy()[s], 4).astype(str),
+                           'in_service': '1',
+                           'status_key': '1'})
+    # Corrupted values seen in the raw files
+    bad = rng.random(n_rows)
+    fields.loc[bad < 0.002, 'avail_bikes'] = '"' + fields['avail_bikes'] + '"'
+    fields.loc[(bad >= 0.002) & (bad < 0.003), 'avail_docks'] = 'NA'
+    fields.loc[(bad >= 0.003) & (bad < 0.004), '_long'] = '--' + fields['_long'].str.lstrip('-')
+
+    lines = fields.iloc[:, 0].str.cat(fields.iloc[:, 1:].astype(str), sep = '\t')
+    packed = rng.random(n_rows) < 0.01
+    lines[packed] = lines[packed] + '\t\t1\t0'
+    lines = embed_headers(lines, '\t'.join(INVENTORY_HEADER), 12)
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return n_rows
+
+
+def synthetic_trips(path, n_rows, n_stations = 300, seed = 0):
+    '''
+    Writes a combined trip csv of n_rows rides over 12 monthly files: the first
+    half unquoted (2013 - 2015 files), the second half with every field quoted
+    (2016 files), and the header of each monthly file inside the file.
+    '''
+    rng = np.random.default_rng(seed)
+    stations = station_table(n_stations, seed)
+    start, end = rng.integers(0, n_stations, n_rows), rng.integers(0, n_stations, n_rows)
+    starttime = pd.Timestamp('{}-01-01'.format(YEAR)) + pd.to_timedelta(np.sort(rng.integers(0, 365 * 86400, n_rows)), unit = 's')
+    duration = rng.integers(60, 3600, n_rows)
+    stoptime = starttime + pd.to_timedelta(duration, unit = 's')
+
+    fields = pd.DataFrame({'tripduration': duration.astype(str),
+                           'starttime': starttime.strftime('%Y-%m-%d %H:%M:%S'),
+                           'stoptime': stoptime.strftime('%Y-%m-%d %H:%M:%S'),
+                           'start station id': stations['station_id'].to_numpy()[start].astype(str),
+                           'start station name': stations['name'].to_numpy()[start],
+                           'start station latitude': stations['latitude'].to_numpy()[start].astype(str),
+                           'start station longitude': stations['longitude'].to_numpy()[start].astype(str),
+                           'end station id': stations['station_id'].to_numpy()[end].astype(str),
+                           'end station name': stations['name'].to_numpy()[end],
+                           'end station latitude': stations['latitude'].to_numpy()[end].astype(str),
+                           'end station longitude': stations['longitude'].to_numpy()[end].astype(str),
+                           'bikeid': rng.integers(14000, 35000, n_rows).astype(str),
+                           'usertype': np.where(rng.random(n_rows) < 0.85, 'Subscriber', 'Customer'),
+                           'birth year': rng.integers(1940, 2002, n_rows).astype(str),
+                           'gender': rng.integers(0, 3, n_rows).astype(str)})
+    quoted = np.arange(n_rows) >= n_rows // 2
+    fields[quoted] = '"' + fields[quoted].astype(object) + '"'
+
+    lines = fields.iloc[:, 0].str.cat(fields.iloc[:, 1:].astype(str), sep = ',')
+    lines = embed_headers(lines, ','.join(TRIP_HEADER), 12)
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return n_rows
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process and its finished children, in MB (None without the resource module)
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def inventory_path(root):
+    return os.path.join(root, 'data', 'stationdata', 'merged{}.csv'.format(YEAR))
+
+
+def trips_path(root):
+    return os.path.join(root, 'all_combined.csv')
+
+
+# Synthetic input files of the benchmarks that read files, written before the benchmark process starts
+SETUPS = {'process_stationdata': lambda root, n: synthetic_inventory(inventory_path(root), n),
+          'cleaning_stationdata': lambda root, n: synthetic_inventory(inventory_path(root), n),
+          'load_sqlite': lambda root, n: synthetic_trips(trips_path(root), n)}
+
+
+def setup_benchmark(name, root, n):
+    if name in SETUPS:
+        SETUPS[name](root, n)
+
+
+def bench_process_stationdata(root, n):
+    from citibike_functions import process_stationdata
+    start_time = time.perf_counter()
+    process_stationdata(YEAR)
+    return n, time.perf_counter() - start_time
+
+
+def bench_cleaning_stationdata(root, n):
+    from citibike_functions import read_stationdata, cleaning_stationdata
+    df = pd.concat(read_stationdata(inventory_path(root)))
+    start_time = time.perf_counter()
+    cleaning_stationdata(df, out = os.path.join(root, 'data', 'stations_cleaned.csv'))
+    return n, time.perf_counter() - start_time
+
+
+def bench_load_sqlite(root, n):
+    from load import load_csv
+    start_time = time.perf_counter()
+    load_csv(trips_path(root), os.path.join(root, 'citibike.sqlite'))
+    return n, time.perf_counter() - start_time
+
+
+def bench_distance_matrix(root, n):
+    # n // 100 stations, i.e. (n // 100) ** 2 distances
+    from citibike_distance import build_distance_matrix
+    stations = station_table(max(n // 100, 10)).set_index('station_id')
+    start_time = time.perf_counter()
+    build_distance_matrix(stations, os.path.join(root, 'station_distance.npy'))
+    return len(stations) ** 2, time.perf_counter() - start_time
+
+
+def bench_arima_backtest(root, n):
+    # 3 cluster series of n // 1000 days (at least 60)
+    from citibike_backtest import walk_forward
+    rng = np.random.default_rng(0)
+    length = max(n // 1000, 60)
+    series = [100 + np.cumsum(rng.normal(0, 5, length)) for _ in range(3)]
+    start_time = time.perf_counter()
+    for values in series:
+        walk_forward(values)
+    return 3 * length, time.perf_counter() - start_time
+
+
+def run_benchmark(name, root, n):
+    '''
+    Runs one benchmark at size n in a scratch directory laid out like the repo
+    (work/ next to data/stationdata/) and returns its measurements. The peak
+    RSS increase is the growth of the high-water mark during the benchmark.
+    '''
+    cwd = os.getcwd()
+    os.chdir(os.path.join(root, 'work'))
+    try:
+        rss_before = peak_rss_mb()
+        rows, seconds = globals()['bench_' + name](root, n)
+        rss_after = peak_rss_mb()
+    finally:
+        os.chdir(cwd)
+    measured = rss_after is not None
+    return {'benchmark': name, 'size': n, 'rows': rows, 'seconds': round(seconds, 4),
+            'rows_per_sec': round(rows / max(seconds, 1e-9), 1),
+            'peak_rss_mb': round(rss_after, 1) if measured else None,
+            'peak_rss_increase_mb': round(rss_after - rss_before, 1) if measured else None}
+
+
+def in_fresh_process(func, *args):
+    with ProcessPoolExecutor(1, mp_context = mp.get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+
+def run_all(benchmarks = BENCHMARKS, sizes = SIZES):
+    results = []
+    for n in sizes:
+        for name in benchmarks:
+            root = tempfile.mkdtemp(prefix = 'citibike_bench_')
+            os.makedirs(os.path.join(root, 'data', 'stationdata'))
+            os.makedirs(os.path.join(root, 'work'))
+            try:
+                # The data is generated in its own process, then a fresh process per benchmark,
+                # so peak RSS is neither the generator's nor carried over from the previous benchmark
+                in_fresh_process(setup_benchmark, name, root, n)
+                result = in_fresh_process(run_benchmark, name, root, n)
+            finally:
+                shutil.rmtree(root, ignore_errors = True)
+            results.append(result)
+            print('{benchmark:>22} {size:>10,} rows: {seconds:9.3f}s {rows_per_sec:>14,.0f} rows/sec'.format(**result) +
+                  ('' if result['peak_rss_mb'] is None else ' {peak_rss_mb:8.1f} MB (+{peak_rss_increase_mb:.1f} MB)'.format(**result)))
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'cpus': os.cpu_count(),
+            'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the ingestion, cleaning and modeling hot paths')
+    parser.add_argument('--sizes', nargs = '+', type = int, default = SIZES, help = 'numbers of synthetic rows')
+    parser.add_argument('--benchmarks', nargs = '+', default = BENCHMARKS, choices = BENCHMARKS, help = 'benchmarks to run')
+    parser.add_argument('--out', default = 'benchmark.json', help = 'JSON report')
+    args = parser.parse_args()
+    report = run_all(args.benchmarks, args.sizes)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent = 2)
+    print('report written to {}'.format(args.out))
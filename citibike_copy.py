@@ -0,0 +1,121 @@
+'''
+Chunked bulk loading with per-chunk commits and resumable checkpoints.
+
+Each chunk of a load is written in its own transaction, with COPY FROM STDIN
+on Postgres (see "Citibike Database.py") or executemany on SQLite, which is
+the fallback used by the tests. The position of the last committed chunk is
+saved in a load_checkpoint table in the same transaction, so a failed run
+resumes after it instead of starting over, and the checkpoint is cleared once
+the load has finished.
+
+The position is either the index of the chunk, for sources that always come
+in the same order (a csv file), or the largest value of a key column, for
+table sources, which are read ordered by that key after the last loaded key.
+'''
+# Import libraries
+import io
+from citibike_query import connect, backend
+from citibike_telemetry import telemetry
+
+CHECKPOINT_TABLES = {'postgres': 'infrastructure.load_checkpoint', 'sqlite': 'load_checkpoint'}
+PARAMS = {'postgres': '%s', 'sqlite': '?'}
+
+
+def copy_dataframe(cur, df, table):
+    '''
+    Streams a dataframe into a table with COPY FROM STDIN. The dataframe is
+    written to an in-memory csv buffer, empty fields are loaded as null values.
+    '''
+    buffer = io.StringIO()
+    df.to_csv(buffer, index = False, header = False)
+    buffer.seek(0)
+    cur.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table, ", ".join(df.columns)), buffer)
+
+
+def insert_dataframe(cur, df, table):
+    # SQLite fallback of copy_dataframe, missing values are inserted as NULL
+    columns = ", ".join('"{}"'.format(col) for col in df.columns)
+    rows = df.astype(object).where(df.notna(), None).itertuples(index = False, name = None)
+    cur.executemany("INSERT INTO {} ({}) VALUES ({})".format(table, columns, ", ".join('?' for _ in df.columns)), rows)
+
+
+def get_checkpoint(cnx, cur, table):
+    '''
+    Returns the position (chunk index or key) of the last chunk committed to a
+    table, or None if no chunk has been loaded since the last complete load.
+    '''
+    dialect = backend(cnx)
+    cur.execute("""
+             CREATE TABLE IF NOT EXISTS {} (
+             table_name TEXT PRIMARY KEY,
+             position BIGINT
+             );
+            """.format(CHECKPOINT_TABLES[dialect]))
+    cur.execute("SELECT position FROM {} WHERE table_name = {}".format(CHECKPOINT_TABLES[dialect], PARAMS[dialect]), (table,))
+    row = cur.fetchone()
+    return None if row is None else row[0]
+
+
+def set_checkpoint(cnx, cur, table, position):
+    dialect = backend(cnx)
+    cur.execute("""
+             INSERT INTO {} (table_name, position) VALUES ({p}, {p})
+             ON CONFLICT (table_name) DO UPDATE SET position = EXCLUDED.position
+            """.format(CHECKPOINT_TABLES[dialect], p = PARAMS[dialect]), (table, int(position)))
+
+
+def clear_checkpoint(cnx, cur, table):
+    dialect = backend(cnx)
+    cur.execute("DELETE FROM {} WHERE table_name = {}".format(CHECKPOINT_TABLES[dialect], PARAMS[dialect]), (table,))
+
+
+def copy_ingest(chunks, table, clean = None, key = None, database = None):
+    '''
+    Loads dataframe chunks into a table with one COPY and one commit per chunk.
+    The optional clean function is applied to each chunk before loading.
+
+    Without key, chunks is an iterable of dataframes that must come in the same
+    order on every run, and a resumed run skips the chunks already committed.
+    With key, chunks is a function of the last loaded key (None for a new load)
+    returning the chunks of the rows after it, ordered by the key column, e.g.
+    a chunked "SELECT ... WHERE key > last ORDER BY key". database is a SQLite
+    file for the SQLite fallback, the citibike Postgres database by default.
+    '''
+    cnx = connect(database)
+    try:
+        cur = cnx.cursor()
+        position = get_checkpoint(cnx, cur, table)
+        cnx.commit()
+        if position is not None:
+            print('Resuming {} after {} {}'.format(table, key or 'chunk', position))
+        if key is not None:
+            chunks = chunks(position)
+
+        write = copy_dataframe if backend(cnx) == 'postgres' else insert_dataframe
+        for i, chunk in enumerate(telemetry.iterate(chunks, table + ': read')):
+            if key is None:
+                if position is not None and i <= position:
+                    continue
+                chunk_position = i
+            elif len(chunk) == 0:
+                continue
+            else:
+                chunk_position = chunk[key].max()
+            if clean is not None:
+                with telemetry.stage(table + ': clean', rows_in = len(chunk)) as stage:
+                    chunk = clean(chunk)
+                    stage.rows_out = len(chunk)
+            with telemetry.stage(table + ': copy', rows_in = len(chunk)) as stage:
+                if len(chunk) > 0:
+                    write(cur, chunk, table)
+                set_checkpoint(cnx, cur, table, chunk_position)
+                cnx.commit()
+                stage.rows_out = len(chunk)
+
+        # The load is complete, so a later run starts a new load instead of skipping every chunk
+        clear_checkpoint(cnx, cur, table)
+        cnx.commit()
+        cur.close()
+    finally:
+        cnx.close()
+    telemetry.report()
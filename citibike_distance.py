@@ -0,0 +1,103 @@
+'''
+Station to station distances.
+
+The full distance matrix is computed with NumPy broadcasting (haversine, in
+miles like the station_distance table) and stored as a float32 .npy file next
+to an index of station ids. Lookups memory-map the matrix, so a distance is an
+array lookup and the nearest stations of a station come from a single row.
+'''
+# Import libraries
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_MILES = 3958.8
+
+# Number of matrix rows computed at a time when building the matrix
+BLOCK_SIZE = 1024
+
+
+def station_coordinates(trips):
+    '''
+    Returns the distinct stations of a trip dataframe with their mean start/end
+    coordinates, indexed by station id.
+    '''
+    start = trips[['start station id', 'start station latitude', 'start station longitude']]
+    end = trips[['end station id', 'end station latitude', 'end station longitude']]
+    start.columns = end.columns = ['station_id', 'latitude', 'longitude']
+    stations = pd.concat([start, end]).dropna()
+    return stations.groupby('station_id')[['latitude', 'longitude']].mean()
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Great circle distance in miles, the inputs are broadcast against each other
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+
+def build_distance_matrix(stations, path = '../data/station_distance.npy'):
+    '''
+    Computes the distance between every pair of stations and writes the matrix to
+    path as float32. stations is a dataframe indexed by station id with latitude
+    and longitude columns (see station_coordinates). The station ids are written
+    to the matching "_ids.npy" file and give the row/column of each station.
+    '''
+    ids = stations.index.to_numpy().astype(np.int64)
+    lat = stations['latitude'].to_numpy(dtype = np.float64)
+    lon = stations['longitude'].to_numpy(dtype = np.float64)
+
+    matrix = np.lib.format.open_memmap(path, mode = 'w+', dtype = np.float32, shape = (len(ids), len(ids)))
+    # Rows are computed in blocks so building the matrix never needs more than a block in float64
+    for i in range(0, len(ids), BLOCK_SIZE):
+        rows = slice(i, i + BLOCK_SIZE)
+        matrix[rows] = haversine(lat[rows, None], lon[rows, None], lat[None, :], lon[None, :])
+    matrix.flush()
+    np.save(index_path(path), ids)
+    return StationDistances(path)
+
+
+def index_path(path):
+    return path[:-len('.npy')] + '_ids.npy' if path.endswith('.npy') else path + '_ids.npy'
+
+
+class StationDistances:
+    '''
+    Read-only access to a distance matrix written by build_distance_matrix.
+    '''
+    def __init__(self, path = '../data/station_distance.npy'):
+        self.matrix = np.load(path, mmap_mode = 'r')
+        self.ids = np.load(index_path(path))
+        self.index = pd.Index(self.ids, name = 'station_id')
+        self.rows = dict(zip(self.ids.tolist(), range(len(self.ids))))
+
+    def distance(self, s_id, e_id):
+        # Distance in miles between two stations
+        return float(self.matrix[self.rows[s_id], self.rows[e_id]])
+
+    def distances(self, s_ids, e_ids):
+        # Vectorized distances for arrays of start and end station ids, unknown ids raise a KeyError
+        s_rows = self.index.get_indexer(s_ids)
+        e_rows = self.index.get_indexer(e_ids)
+        if (s_rows < 0).any() or (e_rows < 0).any():
+            raise KeyError('Unknown station id')
+        return self.matrix[s_rows, e_rows]
+
+    def nearest(self, s_id, k = 5):
+        '''
+        Returns the k stations closest to s_id (excluding itself) as a series of
+        distances indexed by station id, closest first.
+        '''
+        i = self.rows[s_id]
+        row = np.array(self.matrix[i])
+        row[i] = np.inf
+        k = min(k, len(row) - 1)
+        closest = np.argpartition(row, k)[:k]
+        closest = closest[np.argsort(row[closest])]
+        return pd.Series(row[closest], index = self.index[closest], name = 'miles')
+
+    def to_frame(self):
+        # Long format table of every pair, as in the station_distance csv
+        n = len(self.ids)
+        return pd.DataFrame({'s_station_id': np.repeat(self.ids, n),
+                             'e_station_id': np.tile(self.ids, n),
+                             'miles': np.asarray(self.matrix).ravel()})
@@ -0,0 +1,120 @@
+'''
+Calendar, holiday and pricing features for the ride demand models.
+
+Vectorized versions of feature_engineering ("Models/Rider Demand CV") and the
+price column of data_cleaning ("Time Series Data Preparation.ipynb"). Every
+calendar feature only depends on the day, so features are computed once per
+distinct day and broadcast to the rows, and the holiday calendar is cached.
+'''
+# Import libraries
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from pandas.tseries.holiday import USFederalHolidayCalendar
+from pandas.tseries.offsets import CustomBusinessMonthBegin
+
+# Season number of each month, indexed by month number (index 0 is unused)
+SEASONS = np.array([0, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4, 1])
+
+
+@lru_cache(maxsize = None)
+def holiday_dates(start = '01/01/2013', end = '11/30/2020'):
+    # Days flagged by the holidays column, built once instead of on every call
+    federal_holidays = CustomBusinessMonthBegin(calendar = USFederalHolidayCalendar())
+    return pd.date_range(start = start, end = end, freq = federal_holidays).normalize().values
+
+
+@lru_cache(maxsize = None)
+def dst_dates(start, end):
+    '''
+    Creating a dataframe that distinguishes between winter and summer daylight savings times.
+    A 0 denotes winter while a 1 denotes summer. Returns the summer, winter and combined
+    (summer + winter) date strings used by the summer_dst, winter_dst and not_dst columns.
+    The computation is the same as in feature_engineering, it only depends on the first
+    and last timestamps so it is cached.
+    '''
+    dates = pd.date_range(start = start, end = end, tz = 'US/Eastern')
+    df1 = pd.DataFrame({'dst_flag': 1, 'date1': dates.tz_localize(None)}, index = dates)
+
+    # add extra day on each end so that there are no nan's after the join
+    dates = pd.to_datetime(pd.date_range(start = start - pd.to_timedelta(1, 'd'), end = end + pd.to_timedelta(1, 'd'), freq = 'h'), utc = True)
+    df2 = pd.DataFrame({'date2': dates.tz_localize(None)}, index = dates)
+
+    out = df1.join(df2)
+    out['dst_flag'] = (out['date1'] - out['date2']) / pd.to_timedelta(1, unit = 'h') + 5
+    summer_dst = pd.Series(out[out['dst_flag'] == 1].index).dt.strftime('%Y-%m-%d')
+    winter_dst = pd.Series(out[out['dst_flag'] == 0].index).dt.strftime('%Y-%m-%d')
+    total_dst = summer_dst + winter_dst
+    return frozenset(summer_dst), frozenset(winter_dst), frozenset(total_dst)
+
+
+def day_features(days, start, end):
+    '''
+    Computes the calendar features of a DatetimeIndex of distinct days. start and
+    end are the first and last timestamps of the data (used by the dst columns).
+    '''
+    day_strings = pd.Series(days.strftime('%Y-%m-%d'))
+    summer_dst, winter_dst, total_dst = dst_dates(start, end)
+    month = days.month.to_numpy()
+
+    features = {}
+    features['dayofweek'] = days.dayofweek
+    features['weekend'] = (features['dayofweek'] == 6).astype(int)
+    features['holidays'] = np.isin(days.values, holiday_dates()).astype(int)
+    features['month'] = days.strftime('%m')
+    features['quarter'] = ((month - 1) // 3 + 1).astype(int)
+    features['summer_dst'] = day_strings.isin(summer_dst).astype(int).to_numpy()
+    features['winter_dst'] = day_strings.isin(winter_dst).astype(int).to_numpy()
+    # Reversing the boolean values. Want 0 to be equal to dsv and 1 to be not dsv
+    features['not_dst'] = (~day_strings.isin(total_dst)).astype(int).to_numpy()
+    features['dayofyear'] = days.dayofyear
+    features['year'] = days.year
+    features['season'] = SEASONS[month].astype(int)
+    return features
+
+
+def feature_engineering(df, time_col = None):
+    '''
+    Adds the calendar features of feature_engineering to df: dayofweek, weekend,
+    hour, holidays, month, quarter, summer_dst, winter_dst, not_dst, dayofyear,
+    year and season. The timestamps come from the first index level, or from
+    time_col if given.
+    '''
+    times = pd.DatetimeIndex(df.index.get_level_values(0) if time_col is None else df[time_col])
+
+    # Features are computed on the distinct days and broadcast back to the rows
+    codes, days = pd.factorize(times.normalize())
+    features = day_features(pd.DatetimeIndex(days), times.min(), times.max())
+
+    for col in ['dayofweek', 'weekend']:
+        df[col] = np.asarray(features[col])[codes]
+    df['hour'] = times.hour
+    for col in ['holidays', 'month', 'quarter', 'summer_dst', 'winter_dst', 'not_dst', 'dayofyear', 'year', 'season']:
+        df[col] = np.asarray(features[col])[codes]
+    print('completed season column')
+    return df
+
+
+def ride_price(duration_min, usertype):
+    '''
+    Price of each ride: customers pay $3 for the first 30 minutes and $0.15 per
+    minute after that, subscribers pay $0.15 per minute after 45 minutes.
+    '''
+    duration_min = np.asarray(duration_min, dtype = float)
+    customer = np.asarray(usertype) == 'Customer'
+    subscriber = np.asarray(usertype) == 'Subscriber'
+    return np.select([(duration_min <= 30) & customer,
+                      (duration_min > 30) & customer,
+                      (duration_min > 45) & subscriber],
+                     [3, 3 + 0.15 * (duration_min - 30), 0.15 * (duration_min - 45)],
+                     default = 0)
+
+
+def trip_features(rider_df):
+    # Demand, duration, distance and price columns of data_cleaning
+    rider_df['ride_demand'] = 1
+    rider_df['duration_min'] = rider_df['tripduration']
+    rider_df['duration_hour'] = rider_df['tripduration'] / 60
+    rider_df['distance'] = 7.456 * rider_df['duration_hour']
+    rider_df['price'] = ride_price(rider_df['duration_min'], rider_df['usertype'])
+    return rider_df
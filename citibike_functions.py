@@ -1,122 +1,234 @@
 # Import libraries
 import pandas as pd
 import numpy as np
-import re
+import csv
+from citibike_telemetry import telemetry
+from citibike_schema import compact_inventory
 
+# Number of rows to read from the merged station files at each iteration
+STATION_CHUNKSIZE = 500000
 
-import pandas as pd
-
-# Function to process station data for a given year
-def process_stationdata(year):
-    df = pd.read_csv(f"../data/stationdata/merged{year}.csv")
 
+# Function to stream the tab separated payload of a merged station file in chunks.
+# Only the first 13 fields of each line are used, extra fields created by stray tabs are ignored.
+def read_stationdata(path, chunksize = STATION_CHUNKSIZE):
     # Generate the list of columns to be used
-    colnames = df.columns[0].split('\t')
-    df.columns = ['_']
-
-    
-    # Split dataframe into multiple columns and save that to a new temporary dataframe
-    df_expand = df['_'].str.split("\t", expand = True)
-
-    
-    # Drop any unnecessary columns created by the splitting
-    if df_expand.shape[1]>13:
-        df_expand.drop(list(range(13, df_expand.shape[1])), axis = 1, inplace = True)
-    
-    
-    # Assign the correct column names to the dataframe and write it to disk
-    df_expand.columns = colnames[0:13]
-    
-    
-    # Save as new csv file
-    df_expand.to_csv(f"../data/stationdata/stations{year}.csv", index = False)    
-
-
-
-
+    with open(path, 'r') as f:
+        colnames = f.readline().rstrip('\r\n').split('\t')[0:13]
 
+    # Quotes are kept as part of the values, they are removed during cleaning
+    return pd.read_csv(path, sep = '\t', header = None, skiprows = 1, names = colnames,
+                       usecols = range(13), dtype = str, quoting = csv.QUOTE_NONE,
+                       chunksize = chunksize)
 
 
-def cleaning_stationdata(df):
-    df.dropna(inplace = True)
-    df.drop(df[df['dock_id'].apply(lambda x: isinstance(x, str))].index, inplace = True)
-    df = df[df['tot_docks'] < 500]
-    
-    
-    mask = ~df['avail_bikes'].astype(str).str.contains('[A-z]')
-    df = df[mask]
-    
-    
-    # Remove quotation marks
-    df['avail_bikes'] = df['avail_bikes'].apply(lambda x: re.sub("\"", "", str(x)))
-    # Drop empty values
-    df = df[df['avail_bikes'] != ""]
-    # Convert strings to integers
-    df['avail_bikes'] = df['avail_bikes'].astype(float).astype(int)
-    # Remove any row with an impossible number of bikes
-    df = df[df['avail_bikes'] <= 200]
-    
-    mask = ~df['avail_docks'].astype(str).str.contains('[A-z]')
+# Function to process station data for a given year
+def process_stationdata(year, chunksize = STATION_CHUNKSIZE):
+    out = f"../data/stationdata/stations{year}.csv"
+
+    # Save as new csv file, one chunk at a time
+    chunks = telemetry.iterate(read_stationdata(f"../data/stationdata/merged{year}.csv", chunksize), 'stations: read')
+    for i, chunk in enumerate(chunks):
+        with telemetry.stage('stations: write', rows_in = len(chunk)) as stage:
+            chunk.to_csv(out, index = False, mode = 'w' if i == 0 else 'a', header = i == 0)
+            stage.rows_out = len(chunk)
+
+
+# Function to process and clean the station data of one or more years in a single pass.
+# Each chunk of the merged file is cleaned and appended to the output file, so memory
+# use is bounded by the chunk size rather than the size of a year of data.
+# With out = None the cleaned chunks are kept in memory with the compact types instead,
+# and the concatenated dataframe is returned.
+def process_and_clean_stationdata(years, out = "../data/stations_cleaned.csv", chunksize = STATION_CHUNKSIZE):
+    if isinstance(years, int):
+        years = [years]
+
+    n_rows = 0
+    frames = []
+    for year in years:
+        chunks = telemetry.iterate(read_stationdata(f"../data/stationdata/merged{year}.csv", chunksize), 'stations: read')
+        for chunk in chunks:
+            with telemetry.stage('stations: clean', rows_in = len(chunk)) as stage:
+                cleaned = clean_stationdata_frame(chunk, compact = out is None)
+                stage.rows_out = len(cleaned)
+            if out is None:
+                frames.append(cleaned)
+            else:
+                with telemetry.stage('stations: write', rows_in = len(cleaned)) as stage:
+                    cleaned.to_csv(out, index = False, mode = 'w' if n_rows == 0 else 'a', header = n_rows == 0)
+                    stage.rows_out = len(cleaned)
+            n_rows += len(cleaned)
+        print(f'{year}: {n_rows:,} cleaned rows ' + ('loaded' if out is None else 'written'))
+    if out is None:
+        return pd.concat(frames, ignore_index = True)
+    return n_rows
+
+
+# Function to read a cleaned station data file with the compact types of citibike_schema,
+# the time column is replaced by a timestamp column. With a chunksize, returns an iterator of chunks.
+def read_stations_cleaned(path = "../data/stations_cleaned.csv", chunksize = None):
+    if chunksize is None:
+        return compact_inventory(pd.read_csv(path, parse_dates = ['date']))
+    return (compact_inventory(chunk) for chunk in pd.read_csv(path, parse_dates = ['date'], chunksize = chunksize))
+
+
+# Season of each month, indexed by month number (index 0 is unused)
+SEASONS = np.array(['', 'winter', 'winter', 'spring', 'spring', 'spring', 'summer',
+                    'summer', 'summer', 'fall', 'fall', 'fall', 'winter'])
+
+
+# Function to apply a column operation to the unique values of a series only.
+# Station snapshots repeat the same dates, names and coordinates on every row,
+# so cleaning the uniques and broadcasting back is much cheaper than cleaning every row.
+def map_unique(series, func):
+    codes, uniques = pd.factorize(series)
+    values = np.asarray(func(pd.Series(uniques)))
+    return pd.Series(values[codes], index = series.index)
+
+
+# Function to split the quoted "yy-mm-dd" dates of the station snapshots into float year, month
+# and day arrays (null where the date cannot be read). Only the unique dates are parsed.
+def date_parts(series):
+    codes, uniques = pd.factorize(series)
+    parts = pd.Series(uniques, dtype = object).astype(str).str.extract(r'^"?(\d{2,4})-(\d{1,2})-(\d{1,2})"?$')
+    # Missing dates have code -1, which picks the extra null row
+    parts = np.vstack([parts.apply(pd.to_numeric).to_numpy(dtype = float), np.full((1, 3), np.nan)])[codes]
+    year = np.where(parts[:, 0] < 100, parts[:, 0] + 2000, parts[:, 0])
+    return year, parts[:, 1], parts[:, 2]
+
+
+# Function to convert 12-hour clock hours and pm flags to 24-hour time: 12 AM is hour 0 and 12 PM is hour 12.
+# Works on numpy arrays and pandas series alike.
+def clock_hours(hour, pm):
+    return hour - 12 * (hour == 12) + 12 * (pm == 1)
+
+
+# Function to build timestamps arithmetically from year, month, day, hour and minute arrays, without
+# formatting and parsing date strings. Values that do not form a valid date and time become NaT.
+def snapshot_timestamps(year, month, day, hour = 0, minute = 0):
+    year, month, day, hour, minute = np.broadcast_arrays(*(np.asarray(x, dtype = float) for x in (year, month, day, hour, minute)))
+    valid = ((month >= 1) & (month <= 12) & (day >= 1) & (hour >= 0) & (hour < 24) & (minute >= 0) & (minute < 60)
+             & (year % 1 == 0) & (month % 1 == 0) & (day % 1 == 0) & (hour % 1 == 0) & (minute % 1 == 0))
+    months = np.where(valid, (year - 1970) * 12 + month - 1, 0).astype('int64').astype('datetime64[M]')
+    days_in_month = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype('int64')
+    valid &= day <= days_in_month
+
+    days = months.astype('datetime64[D]') + np.where(valid, day - 1, 0).astype('int64')
+    timestamps = days.astype('datetime64[ns]') + (np.where(valid, hour * 60 + minute, 0).astype('int64') * 60 * 10 ** 9).astype('timedelta64[ns]')
+    timestamps[~valid] = np.datetime64('NaT')
+    return timestamps
+
+
+# Function to build the timestamps of station snapshots from their raw date, hour, minute and pm columns
+def inventory_timestamps(date, hour, minute, pm):
+    year, month, day = date_parts(date)
+    hour, minute, pm = (map_unique(col, lambda x: pd.to_numeric(x, errors = 'coerce')).to_numpy(dtype = float) for col in (hour, minute, pm))
+    return pd.Series(snapshot_timestamps(year, month, day, clock_hours(hour, pm), minute), index = date.index)
+
+
+# Function to strip quotes from a bike/dock count column and convert it to numbers.
+# Counts containing letters are corrupted rows and become null.
+def clean_count(series):
+    series = series.astype(str)
+    counts = pd.to_numeric(series.str.replace('"', '', regex = False), errors = 'coerce')
+    return counts.where(~series.str.contains('[A-z]'))
+
+
+def clean_lat(series):
+    return pd.to_numeric(series.astype(str).str.replace('"', '', regex = False), errors = 'coerce')
+
+
+def clean_long(series):
+    series = series.astype(str).str.replace('[^-^.0-9]', '', regex = True).str.replace('-{2}', '-', regex = True)
+    return pd.to_numeric(series, errors = 'coerce')
+
+
+def clean_hour(series):
+    return pd.to_numeric(series.astype(str).str.replace('[^0-9]', '', regex = True), errors = 'coerce')
+
+
+# Function to clean a dataframe of station data and return the cleaned dataframe.
+# The cleaned dataframe has the compact types of citibike_schema (with a timestamp column
+# instead of the time string), or the columns of the cleaned csv file with compact = False.
+def clean_stationdata_frame(df, compact = True):
+    n_rows = len(df)
+    df = df.dropna()
+    telemetry.drop('stations: missing values', n_rows - len(df))
+
+    # Convert the numeric columns, anything that fails to convert is an embedded header or a corrupted row
+    dock_id = pd.to_numeric(df['dock_id'], errors = 'coerce')
+    tot_docks = pd.to_numeric(df['tot_docks'], errors = 'coerce')
+    minute = map_unique(df['minute'], lambda x: pd.to_numeric(x, errors = 'coerce'))
+    avail_bikes = map_unique(df['avail_bikes'], clean_count)
+    avail_docks = map_unique(df['avail_docks'], clean_count)
+
+    # Clean up latitude, longitude and hour columns
+    lat = map_unique(df['_lat'], clean_lat)
+    long = map_unique(df['_long'], clean_long)
+    hour = map_unique(df['hour'], clean_hour)
+
+    # Build the date column from the year, month and day numbers
+    date = pd.Series(snapshot_timestamps(*date_parts(df['date'])), index = df.index)
+
+    # Combine every cleaning rule into one mask so the dataframe is only sliced once.
+    # Empty values and impossible numbers of bikes/docks are removed.
+    rules = {'dock_id': dock_id.notna(),
+             'tot_docks': tot_docks < 500,
+             'minute': minute.notna(),
+             'avail_bikes': avail_bikes.notna() & (avail_bikes <= 200),
+             'avail_docks': avail_docks.notna() & (avail_docks <= 200),
+             '_lat': lat.notna(),
+             '_long': long.notna(),
+             'hour': hour.notna(),
+             'date': date.notna()}
+    mask = np.logical_and.reduce(list(rules.values()))
+    # A row failing several rules is counted by each of them
+    for rule, valid in rules.items():
+        telemetry.drop('stations: invalid ' + rule, len(valid) - valid.sum())
     df = df[mask]
 
-    
-    # Remove quotation marks 
-    df['avail_docks'] = df['avail_docks'].apply(lambda x: re.sub("\"", "", str(x)))
-    # Drop empty values
-    df = df[df['avail_docks'] != ""]
-    # Convert strings to integers
-    df['avail_docks'] = df['avail_docks'].astype(float).astype(int)
-    # Remove number of available docks that are higher than 200
-    df = df[df['avail_docks'] <= 200]
-    
-    
-    # Parse date column into datetime format
-    df['date'] = pd.to_datetime(df['date'], format = '"%y-%m-%d"')
-
-    
-    # Convert numeric columns from strings to integers
-    df['dock_id'] = df['dock_id'].astype(int)
-    df['tot_docks'] = df['tot_docks'].astype(int)
-    df['minute'] = df['minute'].astype(int)
-    
-    # Clean up latitude and longitude columns
-    df['_lat'] = df['_lat'].apply(lambda x: float(re.sub('\"', "", str(x))))
-    df['_long'] = df['_long'].apply(lambda x: re.sub('[^-^.0-9]', "", str(x))).apply(lambda x: re.sub("-{2}", "-", str(x)))
-    df = df[df['_long'] != ""]
-    df['_long'].astype(float)
-    
-    
-    # Clean up hours column
-    df['hour'] = df['hour'].apply(lambda x: re.sub('[^0-9]', "", str(x))).astype(int)
-    
-    # Convert hours to 24-hour time
-    df['hour'].loc[df['pm'] == 1] = df['hour'].loc[df['pm'] == 1] + 12
-
-    # Remove quotations from dock name
-    df['dock_name'] = df['dock_name'].apply(lambda x: str(re.sub('\"', "", x)))
+    avail_bikes = avail_bikes[mask].astype(int)
+    tot_docks = tot_docks[mask].astype(int)
+    hour = hour[mask].astype(int)
+    minute = minute[mask].astype(int)
+    date = date[mask]
 
+    # Convert hours to 24-hour time
+    hour = clock_hours(hour, pd.to_numeric(df['pm'], errors = 'coerce'))
 
     # Create a depletion status column
-    df['depletion_status'] = (df['avail_bikes']/df['tot_docks']).apply(lambda x: "Full Risk" if x > 2/3 else "Empty Risk" if x < 1/3 else "Healthy")
-
-
+    ratio = avail_bikes / tot_docks
+    depletion_status = np.select([ratio > 2/3, ratio < 1/3], ['Full Risk', 'Empty Risk'], default = 'Healthy')
+
+    cleaned = {}
+    for col in df.columns:
+        cleaned[col] = df[col]
+    cleaned.update({'dock_id': dock_id[mask].astype(int),
+                    # Remove quotations from dock name
+                    'dock_name': map_unique(df['dock_name'], lambda x: x.astype(str).str.replace('"', '', regex = False)),
+                    'date': date,
+                    'hour': hour,
+                    'minute': minute,
+                    'avail_bikes': avail_bikes,
+                    'avail_docks': avail_docks[mask].astype(int),
+                    'tot_docks': tot_docks,
+                    '_lat': lat[mask],
+                    '_long': long[mask],
+                    'depletion_status': depletion_status})
     # Drop unnecessary columns
-    df.drop(['pm'], axis = 1, inplace = True)
-
+    del cleaned['pm']
 
     # Create new variables -> time, day of the week, and season
-    # time variable
-    df = df.assign(time = lambda x: x['hour'].astype(str) + ":" + x['minute'].astype(str))
-    # day of the week variable
-    df = df.assign(dayofweek = lambda x: x['date'].dt.weekday)
-    # season variable
-    df = df.assign(\
-        season = lambda x: x['date'].dt.month.apply(\
-        lambda y: 'winter' if y <= 2 else 'spring' if y <= 5 else 'summer' if y <= 8 else 'fall' if y <= 11 else 'winter'))
-    
-    # Create a new csv file
-    df.to_csv("../data/stations_cleaned.csv", index = False)
-
+    cleaned['time'] = map_unique(hour * 100 + minute, lambda x: (x // 100).astype(str) + ":" + (x % 100).astype(str))
+    cleaned['dayofweek'] = date.dt.weekday
+    cleaned['season'] = SEASONS[date.dt.month.to_numpy()]
+    cleaned = pd.DataFrame(cleaned, index = df.index)
+    return compact_inventory(cleaned) if compact else cleaned
 
 
+def cleaning_stationdata(df, out = "../data/stations_cleaned.csv"):
+    df = clean_stationdata_frame(df, compact = False)
 
+    # Create a new csv file, and return the cleaned data with the compact types
+    df.to_csv(out, index = False)
+    return compact_inventory(df)
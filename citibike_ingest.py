@@ -0,0 +1,184 @@
+'''
+Parallel ingestion of the monthly Citi Bike trip files.
+
+Instead of concatenating every *-citibike-tripdata.csv into one file and parsing
+it with a single process, each monthly file is parsed, normalized to the
+canonical ride schema, typed and written out by a worker of a process pool.
+'''
+# Import libraries
+import os
+import glob
+import argparse
+import multiprocessing as mp
+import pandas as pd
+import numpy as np
+from citibike_storage import write_rides
+from citibike_schema import RIDE_DTYPES
+from citibike_telemetry import telemetry
+
+# Canonical ride columns (the 2013 - 2016 trip file header)
+RIDE_COLUMNS = ['tripduration', 'starttime', 'stoptime', 'start station id', 'start station name',
+                'start station latitude', 'start station longitude', 'end station id', 'end station name',
+                'end station latitude', 'end station longitude', 'bikeid', 'usertype', 'birth year', 'gender']
+
+# Column names used by the other trip file schemas, mapped to the canonical names.
+# Oct 2016 - Mar 2017 files use title case names ("Trip Duration", "Start Station ID", ...),
+# files from Feb 2021 onwards use the new ride_id/started_at schema.
+RIDE_COLUMN_ALIASES = {'trip duration': 'tripduration',
+                       'start time': 'starttime',
+                       'stop time': 'stoptime',
+                       'bike id': 'bikeid',
+                       'user type': 'usertype',
+                       'started_at': 'starttime',
+                       'ended_at': 'stoptime',
+                       'start_station_id': 'start station id',
+                       'start_station_name': 'start station name',
+                       'start_lat': 'start station latitude',
+                       'start_lng': 'start station longitude',
+                       'end_station_id': 'end station id',
+                       'end_station_name': 'end station name',
+                       'end_lat': 'end station latitude',
+                       'end_lng': 'end station longitude',
+                       'member_casual': 'usertype'}
+
+# User types of the 2021 schema, mapped to the user types of the earlier schemas
+USERTYPES = {'member': 'Subscriber', 'casual': 'Customer'}
+
+# Station ids of the 2021 schema are decimal numbers (e.g. "5329.03"), they are mapped to
+# DECIMAL_ID_OFFSET + the id times 100 so they fit the integer station id columns without
+# colliding with the ids of the earlier schemas
+DECIMAL_ID_OFFSET = 1000000
+STATION_ID_COLUMNS = ('start station id', 'end station id')
+
+# Default location of the per-file outputs
+OUTPUT_DIR = "../data/ride data/ingested"
+
+
+def normalize_columns(columns):
+    '''
+    Maps the header of a trip file to the canonical column names. Columns
+    that are not part of the canonical schema (e.g. ride_id) map to None.
+    '''
+    names = []
+    for col in columns:
+        col = col.strip().strip('"').lower()
+        col = RIDE_COLUMN_ALIASES.get(col, col)
+        names.append(col if col in RIDE_COLUMNS else None)
+    if 'starttime' not in names or 'start station id' not in names:
+        raise ValueError('Unrecognized trip file header: {}'.format(list(columns)))
+    return names
+
+
+def station_ids(values, lookup = None):
+    '''
+    Converts a column of raw station ids to integer ids. Whole numbers are kept,
+    decimal ids of the 2021 schema are mapped to DECIMAL_ID_OFFSET + id * 100
+    and other ids (e.g. "JC013") are looked up in lookup, a dict of raw id to
+    integer id. Ids that cannot be resolved become null and are counted.
+    '''
+    values = pd.Series(values)
+    if values.dtype == object:
+        values = values.str.strip()
+    numbers = pd.to_numeric(values, errors = 'coerce')
+    ids = numbers.where(numbers % 1 == 0, DECIMAL_ID_OFFSET + (numbers * 100).round())
+    if lookup:
+        ids = ids.fillna(values.map(lookup))
+    telemetry.drop('ingest: unresolved {}'.format(values.name), (values.notna() & ids.isna()).sum())
+    return ids
+
+
+def normalize_trips(df, station_lookup = None):
+    '''
+    Renames the columns of a trip dataframe to the canonical schema, fills the
+    columns missing from newer schemas and converts every column to its type.
+    Embedded header lines and rows without a valid start time are dropped.
+    Station ids are converted by station_ids, with station_lookup for the ids
+    that are not numbers.
+    '''
+    names = normalize_columns(df.columns)
+    df = df.loc[:, [name is not None for name in names]].copy()
+    df.columns = [name for name in names if name is not None]
+
+    # Each file uses one datetime format, so it is inferred once per file
+    df['starttime'] = pd.to_datetime(df['starttime'], errors = 'coerce')
+    df['stoptime'] = pd.to_datetime(df['stoptime'], errors = 'coerce')
+    valid = df['starttime'].notna() & df['stoptime'].notna()
+
+    if 'tripduration' not in df.columns:
+        df['tripduration'] = (df['stoptime'] - df['starttime']).dt.total_seconds()
+    df['usertype'] = df['usertype'].replace(USERTYPES)
+    for col in ('bikeid', 'birth year', 'gender'):
+        if col not in df.columns:
+            df[col] = np.nan
+
+    for col, dtype in RIDE_DTYPES.items():
+        if dtype == 'category':
+            # Invalid rows are masked first so header text does not become a category
+            df[col] = df[col].where(valid).astype(dtype)
+            continue
+        if col in STATION_ID_COLUMNS:
+            # Embedded header lines are masked first so they are not counted as unresolved ids
+            values = station_ids(df[col].where(valid), station_lookup)
+        else:
+            values = pd.to_numeric(df[col], errors = 'coerce')
+        if dtype.startswith('Int'):
+            values = values.where(values % 1 == 0)
+        elif dtype.startswith('int'):
+            values = values.fillna(0)
+        df[col] = values.astype(dtype)
+    return df.loc[valid, RIDE_COLUMNS]
+
+
+def output_path(path, out_dir):
+    name = os.path.basename(path)
+    for ext in ('.zip', '.csv'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return os.path.join(out_dir, name + '.parquet')
+
+
+def ingest_file(path, out_dir = OUTPUT_DIR, store = None):
+    '''
+    Parses, normalizes and types one monthly trip file (csv or zipped csv).
+    The result is written to a parquet file of its own in out_dir, or appended
+    to the partitioned rides dataset at store. Returns the path and row count.
+    '''
+    df = normalize_trips(pd.read_csv(path, dtype = str))
+    if store is not None:
+        write_rides(df, store)
+    else:
+        df.to_parquet(output_path(path, out_dir), index = False)
+    return path, len(df)
+
+
+def ingest_worker(args):
+    return ingest_file(*args)
+
+
+def ingest_files(pattern, out_dir = OUTPUT_DIR, store = None, processes = None):
+    '''
+    Ingests every trip file matching pattern with a pool of processes (one per
+    core by default). Files are processed independently, so ingestion scales
+    with the number of cores. Returns the total number of rows ingested.
+    '''
+    files = sorted(glob.glob(pattern))
+    if store is None:
+        os.makedirs(out_dir, exist_ok = True)
+
+    n_rows = 0
+    with mp.Pool(processes) as pool:
+        for path, rows in pool.imap_unordered(ingest_worker, [(f, out_dir, store) for f in files]):
+            n_rows += rows
+            print('{}: {:,} rows'.format(os.path.basename(path), rows))
+    print('{:,} rows ingested from {} files'.format(n_rows, len(files)))
+    return n_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Ingest monthly trip files in parallel')
+    parser.add_argument('pattern', help = 'glob pattern of the trip files, e.g. "../data/ride data/*-citibike-tripdata.csv"')
+    parser.add_argument('--out-dir', default = OUTPUT_DIR, help = 'directory for the per-file parquet outputs')
+    parser.add_argument('--store', default = None, help = 'write to this partitioned rides dataset instead')
+    parser.add_argument('--processes', type = int, default = None, help = 'number of worker processes')
+    args = parser.parse_args()
+    ingest_files(args.pattern, args.out_dir, args.store, args.processes)
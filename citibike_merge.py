@@ -0,0 +1,132 @@
+'''
+Streaming merge of the monthly Citi Bike trip files into one clean csv.
+
+bash_script.sh, run.cmd and ridedata_merge.ipynb concatenate the monthly files
+with their headers stripped inconsistently, so embedded header lines end up in
+the combined file and every chunk of it has to be scrubbed row by row. Here the
+header of each file is read and mapped to the canonical ride schema (see
+citibike_ingest). Files already in the canonical column order are copied in
+large blocks, with any embedded header line removed by a regular expression
+over the raw bytes. Files of the other schema eras (Feb 2021 onwards) are
+normalized with pandas. The output has a single canonical header.
+'''
+# Import libraries
+import io
+import re
+import os
+import sys
+import csv
+import glob
+import zipfile
+import argparse
+import pandas as pd
+from citibike_ingest import RIDE_COLUMNS, normalize_columns, normalize_trips
+from citibike_telemetry import telemetry
+
+# Bytes copied at a time from the files in the canonical column order
+BLOCKSIZE = 16 * 1024 ** 2
+# Rows normalized at a time from the files of the other schemas
+CHUNKSIZE = 500000
+
+# A header line starts with the name of the first column of one of the schema eras, possibly quoted
+HEADER_LINE = re.compile(rb'^(?:\xef\xbb\xbf)?"?(?:tripduration|trip duration|ride_id)"?,[^\n]*(?:\n|$)', re.IGNORECASE | re.MULTILINE)
+
+
+def open_trip_file(path):
+    # Binary stream of a trip file, or of the csv inside a zipped trip file
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        name = next(name for name in archive.namelist() if name.endswith('.csv') and not name.startswith('__MACOSX'))
+        return archive.open(name)
+    return open(path, 'rb')
+
+
+def header_columns(line):
+    # Column names of a raw header line
+    return next(csv.reader([line.decode('utf-8-sig').rstrip('\r\n')]))
+
+
+def copy_rows(stream, out, blocksize = BLOCKSIZE):
+    '''
+    Copies the rows of a trip file in the canonical column order from stream to
+    out in blocks, removing embedded header lines. Blocks are cut at the last
+    line break so a header line is never split. Returns the number of header
+    lines removed.
+    '''
+    n_headers = 0
+    tail = b''
+    while True:
+        block = stream.read(blocksize)
+        if not block:
+            break
+        block = tail + block
+        end = block.rfind(b'\n') + 1
+        block, tail = block[:end], block[end:]
+        block, n = HEADER_LINE.subn(b'', block)
+        n_headers += n
+        out.write(block)
+    if tail:
+        tail, n = HEADER_LINE.subn(b'', tail)
+        n_headers += n
+        # The last line of a file may lack its line break
+        out.write(tail if not tail or tail.endswith(b'\n') else tail + b'\n')
+    return n_headers
+
+
+def normalize_rows(stream, columns, out, chunksize = CHUNKSIZE):
+    '''
+    Writes the rows of a trip file of another schema era to out in the
+    canonical column order, with the canonical types (see normalize_trips).
+    Embedded header lines and rows without valid times are dropped. Returns
+    the number of rows dropped.
+    '''
+    n_dropped = 0
+    text = io.TextIOWrapper(stream, encoding = 'utf-8', newline = '')
+    for chunk in pd.read_csv(text, header = None, names = columns, dtype = str, chunksize = chunksize):
+        df = normalize_trips(chunk)
+        n_dropped += len(chunk) - len(df)
+        out.write(df.to_csv(index = False, header = False, date_format = '%Y-%m-%d %H:%M:%S').encode('utf-8'))
+    text.detach()
+    return n_dropped
+
+
+def merge_trip_files(paths, out, blocksize = BLOCKSIZE, chunksize = CHUNKSIZE):
+    '''
+    Merges trip files (csv or zipped csv) into out, a path or a binary file
+    object (e.g. sys.stdout.buffer to stream into COPY). The merged csv has one
+    canonical header and no embedded header lines. Returns the number of files
+    merged.
+    '''
+    own_file = isinstance(out, str)
+    if own_file:
+        out = open(out, 'wb')
+    try:
+        out.write((','.join(RIDE_COLUMNS) + '\n').encode('utf-8'))
+        for path in paths:
+            name = os.path.basename(path)
+            with telemetry.stage('merge: ' + name), open_trip_file(path) as stream:
+                columns = header_columns(stream.readline())
+                if normalize_columns(columns) == RIDE_COLUMNS:
+                    telemetry.drop('merge: header lines', copy_rows(stream, out, blocksize))
+                else:
+                    telemetry.drop('merge: invalid rows', normalize_rows(stream, columns, out, chunksize))
+            print(name + ' merged', file = sys.stderr)
+    finally:
+        if own_file:
+            out.close()
+    return len(paths)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Merge monthly trip files into one csv with a single canonical header')
+    parser.add_argument('pattern', help = 'glob pattern of the trip files, e.g. "../data/ride data/*-citibike-tripdata.csv"')
+    parser.add_argument('--out', default = '-', help = 'merged csv file, "-" for standard output')
+    parser.add_argument('--blocksize', type = int, default = BLOCKSIZE, help = 'bytes copied at a time')
+    parser.add_argument('--chunksize', type = int, default = CHUNKSIZE, help = 'rows normalized at a time')
+    args = parser.parse_args()
+    files = sorted(glob.glob(args.pattern))
+    if args.out == '-':
+        merge_trip_files(files, sys.stdout.buffer, args.blocksize, args.chunksize)
+    else:
+        merge_trip_files(files, args.out, args.blocksize, args.chunksize)
+        telemetry.report()
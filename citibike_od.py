@@ -0,0 +1,173 @@
+'''
+Sparse origin-destination flow matrices of the rides.
+
+Rides are counted per (start station, end station) pair in one SciPy sparse
+matrix per hour of day and day type (weekday or weekend). Stations are
+indexed by a growing CategoryDictionary of station ids, so the row/column of
+a station never changes and new months of rides are added to the existing
+matrices without rebuilding them. Departures, arrivals and net inflow per
+station are row and column sums of the matrices.
+'''
+# Import libraries
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from citibike_schema import CategoryDictionary
+from citibike_storage import read_rides, RIDES_ROOT
+
+OD_DIR = '../data/od'
+DAY_TYPES = ('weekday', 'weekend')
+HOURS = range(24)
+OD_COLUMNS = ['starttime', 'start station id', 'end station id']
+
+
+class FlowMatrices:
+    '''
+    Ride counts per hour of day and day type, as station x station sparse
+    matrices (rows are start stations, columns end stations).
+
+        flows = FlowMatrices()
+        flows.add(rides, label = '2019-01')
+        flows.matrix('weekday', hour = 8)
+        flows.net_inflow('weekday', hour = 8)
+    '''
+    def __init__(self, stations = (), matrices = None, labels = ()):
+        self.stations = CategoryDictionary(stations)
+        self.matrices = matrices or {}
+        # Labels of the ride batches already added (e.g. months), so a batch is never counted twice
+        self.labels = set(labels)
+
+    @property
+    def station_ids(self):
+        return pd.Index(self.stations.categories, name = 'station_id')
+
+    def add(self, rides, label = None):
+        '''
+        Adds the rides of a dataframe with starttime, start station id and end
+        station id columns. Rides without both stations are ignored. If label
+        was already added, the rides are skipped. Returns the rides counted.
+        '''
+        if label is not None and label in self.labels:
+            return 0
+        rides = rides.dropna(subset = ['start station id', 'end station id'])
+        origin = self.stations.encode(rides['start station id'].to_numpy()).cat.codes.to_numpy()
+        destination = self.stations.encode(rides['end station id'].to_numpy()).cat.codes.to_numpy()
+        n = len(self.stations.categories)
+
+        times = pd.DatetimeIndex(rides['starttime'])
+        bucket = (times.dayofweek >= 5).astype('int64') * 24 + times.hour
+        # Rides are sorted by bucket once, each bucket's slice becomes a sparse matrix (duplicates are summed)
+        order = np.argsort(bucket, kind = 'stable')
+        bucket, origin, destination = bucket[order], origin[order], destination[order]
+        bounds = np.searchsorted(bucket, np.arange(len(DAY_TYPES) * 24 + 1))
+
+        for key, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+            day_type, hour = DAY_TYPES[key // 24], key % 24
+            counts = self.matrices.get((day_type, hour))
+            if counts is None:
+                counts = sp.csr_matrix((n, n), dtype = 'int64')
+            elif counts.shape != (n, n):
+                # New stations get new rows and columns, the existing ones keep their position
+                counts.resize((n, n))
+            if hi > lo:
+                counts = counts + sp.csr_matrix((np.ones(hi - lo, dtype = 'int64'), (origin[lo:hi], destination[lo:hi])), shape = (n, n))
+            self.matrices[(day_type, hour)] = counts
+
+        if label is not None:
+            self.labels.add(label)
+        return len(rides)
+
+    def matrix(self, day_type = None, hour = None):
+        '''
+        Sum of the matrices of a day type and/or hour (or list of hours), every
+        bucket by default. Matrices built before new stations were added are
+        padded to the current number of stations.
+        '''
+        day_types = DAY_TYPES if day_type is None else [day_type]
+        hours = HOURS if hour is None else np.atleast_1d(hour)
+        n = len(self.stations.categories)
+        total = sp.csr_matrix((n, n), dtype = 'int64')
+        for key in ((d, int(h)) for d in day_types for h in hours):
+            if key in self.matrices:
+                counts = self.matrices[key]
+                if counts.shape != (n, n):
+                    counts.resize((n, n))
+                total = total + counts
+        return total
+
+    def outflow(self, day_type = None, hour = None):
+        # Rides starting at each station
+        return pd.Series(np.asarray(self.matrix(day_type, hour).sum(axis = 1)).ravel(), index = self.station_ids, name = 'outflow')
+
+    def inflow(self, day_type = None, hour = None):
+        # Rides ending at each station
+        return pd.Series(np.asarray(self.matrix(day_type, hour).sum(axis = 0)).ravel(), index = self.station_ids, name = 'inflow')
+
+    def net_inflow(self, day_type = None, hour = None):
+        # Arrivals minus departures of each station, negative for the stations losing bikes
+        counts = self.matrix(day_type, hour)
+        net = np.asarray(counts.sum(axis = 0)).ravel() - np.asarray(counts.sum(axis = 1)).ravel()
+        return pd.Series(net, index = self.station_ids, name = 'net_inflow')
+
+    def frame(self, day_type = None, hour = None):
+        # Non-zero flows as a long dataframe of start station id, end station id and rides
+        counts = self.matrix(day_type, hour).tocoo()
+        ids = self.station_ids
+        return pd.DataFrame({'start station id': ids[counts.row], 'end station id': ids[counts.col], 'rides': counts.data})
+
+    def save(self, path = OD_DIR):
+        # One .npz file per bucket, with the station ids and labels in index.json
+        os.makedirs(path, exist_ok = True)
+        for (day_type, hour), counts in self.matrices.items():
+            sp.save_npz(os.path.join(path, '{}_{:02d}.npz'.format(day_type, hour)), counts)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'stations': [int(s) for s in self.stations.categories], 'labels': sorted(self.labels)}, f)
+
+    @classmethod
+    def load(cls, path = OD_DIR):
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        matrices = {}
+        for day_type in DAY_TYPES:
+            for hour in HOURS:
+                file = os.path.join(path, '{}_{:02d}.npz'.format(day_type, hour))
+                if os.path.exists(file):
+                    matrices[(day_type, hour)] = sp.load_npz(file).tocsr()
+        return cls(index['stations'], matrices, index['labels'])
+
+
+def month_starts(start, end):
+    # First day of every month in [start, end)
+    return pd.date_range(pd.Timestamp(start).to_period('M').to_timestamp(), end, freq = 'MS', inclusive = 'left')
+
+
+def update_months(flows, start, end, root = RIDES_ROOT):
+    '''
+    Adds the months of rides between start and end from the partitioned rides
+    dataset, one month at a time. Months already added are skipped, so the
+    matrices can be kept up to date by re-running with a later end.
+    '''
+    for month in month_starts(start, end):
+        label = month.strftime('%Y-%m')
+        if label in flows.labels:
+            continue
+        rides = read_rides(root, columns = OD_COLUMNS, start = month, end = month + pd.offsets.MonthBegin())
+        print('{}: {:,} rides'.format(label, flows.add(rides, label)))
+    return flows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Build or update the origin-destination flow matrices')
+    parser.add_argument('start', help = 'first month, e.g. 2019-01')
+    parser.add_argument('end', help = 'end of the period (excluded), e.g. 2020-01')
+    parser.add_argument('--root', default = RIDES_ROOT, help = 'partitioned rides dataset')
+    parser.add_argument('--out', default = OD_DIR, help = 'directory of the matrices, updated if it exists')
+    args = parser.parse_args()
+
+    flows = FlowMatrices.load(args.out) if os.path.exists(os.path.join(args.out, 'index.json')) else FlowMatrices()
+    update_months(flows, args.start, args.end, args.root)
+    flows.save(args.out)
+    print('{} stations, {:,} rides'.format(len(flows.station_ids), flows.matrix().sum()))
@@ -0,0 +1,261 @@
+'''
+Cluster-aware queries over the ride and dock inventory tables.
+
+Works on the infrastructure_final schema in Postgres (see "Citibike
+Database.py") or on the SQLite database built by load.py. Station clusters are
+stored in a station_clusters table keyed by station id, and the series the
+models need (daily empty/full/healthy snapshots of a cluster, rides per
+cluster) are filtered and aggregated in SQL through the composite
+(dock_id, date) and (start station id, starttime) indexes, so only the
+aggregated rows are fetched. SQLite time filters compare text, so they expect
+ISO formatted times.
+'''
+# Import libraries
+import sqlite3
+from contextlib import contextmanager
+import pandas as pd
+
+DSN = 'dbname = citibike user = postgres password = ***'
+
+# Table and column names of each backend
+SCHEMAS = {'postgres': {'rides': 'infrastructure_final.Ride_Data',
+                        'inventory': 'infrastructure_final.Inventory',
+                        'stations': 'infrastructure_final.Stations',
+                        'clusters': 'infrastructure_final.station_clusters',
+                        'start_station_id': 'start_station_id',
+                        'param': '%s'},
+           'sqlite': {'rides': 'allrides',
+                      'inventory': 'inventory',
+                      'stations': 'stations',
+                      'clusters': 'station_clusters',
+                      'start_station_id': '[start station id]',
+                      'param': '?'}}
+
+# SQL expression truncating a time column to each frequency
+BUCKETS = {'postgres': {'H': "date_trunc('hour', {})", 'd': "date_trunc('day', {})", 'm': "date_trunc('month', {})"},
+           'sqlite': {'H': "strftime('%Y-%m-%d %H:00:00', {})", 'd': "date({})", 'm': "strftime('%Y-%m-01', {})"}}
+
+# Fractions of tot_docks below which a dock is empty and above which it is full. These are
+# the thresholds of dock_status ('Empty Alert'/'Full Alert') in stationdata_cleaning.ipynb,
+# which the dock status models use; depletion_status (see clean_stationdata_frame) uses (1/3, 2/3).
+STATUS_THRESHOLDS = (3/10, 7/10)
+
+# Dock status labels of the notebooks, each is only the same status with the matching thresholds
+STATUS_LABELS = {'empty alert': 'empty', 'full alert': 'full', 'empty risk': 'empty', 'full risk': 'full'}
+LABEL_THRESHOLDS = {'alert': STATUS_THRESHOLDS, 'risk': (1/3, 2/3)}
+
+
+def connect(database = None):
+    # SQLite connection for a .sqlite file, Postgres connection to the citibike database otherwise
+    if database is not None and database.endswith('.sqlite'):
+        return sqlite3.connect(database)
+    import psycopg2
+    return psycopg2.connect(DSN if database is None else database)
+
+
+@contextmanager
+def connection(cnx = None):
+    # Uses cnx if given, otherwise opens a connection to the default database and closes it afterwards
+    if cnx is not None:
+        yield cnx
+        return
+    cnx = connect()
+    try:
+        yield cnx
+    finally:
+        cnx.close()
+
+
+def backend(cnx):
+    return 'sqlite' if isinstance(cnx, sqlite3.Connection) else 'postgres'
+
+
+def table_exists(cnx, table):
+    cur = cnx.cursor()
+    if backend(cnx) == 'sqlite':
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        exists = cur.fetchone() is not None
+    else:
+        cur.execute("SELECT to_regclass(%s)", (table,))
+        exists = cur.fetchone()[0] is not None
+    cur.close()
+    return exists
+
+
+def fetch(cnx, query, params = ()):
+    # Runs a query and returns the result as a dataframe
+    cur = cnx.cursor()
+    cur.execute(query, params)
+    df = pd.DataFrame(cur.fetchall(), columns = [col[0] for col in cur.description])
+    cur.close()
+    return df
+
+
+def create_query_indexes(cnx):
+    '''
+    Creates the cluster table and the composite indexes the queries rely on:
+    station_clusters (cluster, station_id), inventory (dock_id, date) and
+    rides (start station id, starttime). Indexes of missing tables are skipped,
+    e.g. the SQLite database built by load.py has no inventory table.
+    '''
+    names = SCHEMAS[backend(cnx)]
+    cur = cnx.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS {} (station_id BIGINT PRIMARY KEY, cluster INT NOT NULL)".format(names['clusters']))
+    # Index names follow create_indexes in "Citibike Database.py" and citibike_sql, so existing indexes are reused
+    for table, cols in ((names['clusters'], ('cluster', 'station_id')),
+                        (names['inventory'], ('dock_id', 'date')),
+                        (names['rides'], (names['start_station_id'], 'starttime'))):
+        if not table_exists(cnx, table):
+            continue
+        index_name = '{}_{}_idx'.format(table.split('.')[-1], '_'.join(cols)).lower().replace('[', '').replace(']', '').replace(' ', '_')
+        cur.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(index_name, table, ", ".join(cols)))
+    cnx.commit()
+    cur.close()
+
+
+def store_clusters(cnx, kmeans):
+    '''
+    Stores the cluster of each station in the station_clusters table, replacing
+    the previous assignments. kmeans is a dataframe with a cluster column and
+    either a station id column ('start station id' or 'station_id') or the
+    'start station name' column of kmeans_output, matched to the stations table.
+    '''
+    names = SCHEMAS[backend(cnx)]
+    p = names['param']
+    create_query_indexes(cnx)
+    cur = cnx.cursor()
+    cur.execute("DELETE FROM {}".format(names['clusters']))
+
+    id_col = next((col for col in ('start station id', 'station_id') if col in kmeans.columns), None)
+    if id_col is not None:
+        rows = kmeans[[id_col, 'cluster']].dropna().astype('int64').itertuples(index = False, name = None)
+        cur.executemany("INSERT INTO {} VALUES ({}, {})".format(names['clusters'], p, p), list(rows))
+    else:
+        cur.execute("CREATE TEMPORARY TABLE kmeans_names (station_name TEXT, cluster INT)")
+        rows = kmeans[['start station name', 'cluster']].itertuples(index = False, name = None)
+        cur.executemany("INSERT INTO kmeans_names VALUES ({}, {})".format(p, p), [(name, int(cluster)) for name, cluster in rows])
+        cur.execute("""INSERT INTO {} SELECT s.station_id, MIN(k.cluster)
+                       FROM kmeans_names k JOIN {} s ON s.station_name = k.station_name
+                       GROUP BY s.station_id""".format(names['clusters'], names['stations']))
+        cur.execute("DROP TABLE kmeans_names")
+    cnx.commit()
+    cur.close()
+
+
+def time_filter(column, start, end, param):
+    # WHERE clause conditions and parameters of a [start, end) time range
+    conditions, params = [], []
+    if start is not None:
+        conditions.append('{} >= {}'.format(column, param))
+        params.append(str(pd.Timestamp(start)))
+    if end is not None:
+        conditions.append('{} < {}'.format(column, param))
+        params.append(str(pd.Timestamp(end)))
+    return conditions, params
+
+
+def status_sql(thresholds = STATUS_THRESHOLDS):
+    # Dock status of a snapshot, the ratio avail_bikes / tot_docks is compared to the thresholds like in pandas
+    low, high = (float(x) for x in thresholds)
+    ratio = 'CAST(avail_bikes AS DOUBLE PRECISION) / NULLIF(tot_docks, 0)'
+    return """CASE WHEN {ratio} > {high!r} THEN 'full'
+                   WHEN {ratio} < {low!r} THEN 'empty'
+                   ELSE 'healthy' END""".format(ratio = ratio, low = low, high = high)
+
+
+def normalize_status(status, thresholds = STATUS_THRESHOLDS):
+    '''
+    Returns 'empty', 'full' or 'healthy'. The labels of the notebooks ('Empty
+    Alert', 'Full Risk', ...) are only accepted with their own thresholds, so
+    a series is never counted with other thresholds than its label says.
+    '''
+    status = status.lower()
+    if status in STATUS_LABELS:
+        expected = LABEL_THRESHOLDS[status.split()[1]]
+        if not all(abs(a - b) < 1e-12 for a, b in zip(thresholds, expected)):
+            raise ValueError('{!r} is counted with the thresholds {}, not {}'.format(status, expected, tuple(thresholds)))
+        status = STATUS_LABELS[status]
+    if status not in ('empty', 'full', 'healthy'):
+        raise ValueError('Unknown dock status: {}'.format(status))
+    return status
+
+
+def series_frame(df):
+    df['bucket'] = pd.to_datetime(df['bucket'])
+    return df
+
+
+def inventory_series(cluster, status, freq = 'd', start = None, end = None, cnx = None, thresholds = STATUS_THRESHOLDS):
+    '''
+    Number of dock snapshots with the given status ('empty', 'full' or
+    'healthy') per freq bucket ('H', 'd' or 'm') for the docks of a cluster,
+    between start (included) and end (excluded). With the default thresholds,
+    same as a slice of daily_inventory in "Time Series of Dock Status.ipynb"
+    (e.g. status 'Empty Alert').
+    '''
+    with connection(cnx) as cnx:
+        dialect = backend(cnx)
+        names = SCHEMAS[dialect]
+        p = names['param']
+        conditions, params = time_filter('i.date', start, end, p)
+        query = """SELECT {bucket} AS bucket, COUNT(*) AS snapshots
+                   FROM {clusters} c JOIN {inventory} i ON i.dock_id = c.station_id
+                   WHERE c.cluster = {p} AND {status} = {p} {times}
+                   GROUP BY 1 ORDER BY 1""".format(bucket = BUCKETS[dialect][freq].format('i.date'), clusters = names['clusters'],
+                                                   inventory = names['inventory'], p = p, status = status_sql(thresholds),
+                                                   times = ''.join(' AND ' + c for c in conditions))
+        df = series_frame(fetch(cnx, query, [int(cluster), normalize_status(status, thresholds)] + params))
+        return df.set_index('bucket')['snapshots']
+
+
+def inventory_by_cluster(freq = 'd', start = None, end = None, cnx = None, thresholds = STATUS_THRESHOLDS):
+    '''
+    Number of dock snapshots per freq bucket, cluster and status ('empty',
+    'full' or 'healthy'), indexed like daily_inventory in "Time Series of Dock
+    Status.ipynb".
+    '''
+    with connection(cnx) as cnx:
+        dialect = backend(cnx)
+        names = SCHEMAS[dialect]
+        conditions, params = time_filter('i.date', start, end, names['param'])
+        query = """SELECT {bucket} AS bucket, c.cluster, {status} AS dock_status, COUNT(*) AS snapshots
+                   FROM {clusters} c JOIN {inventory} i ON i.dock_id = c.station_id
+                   {where}
+                   GROUP BY 1, 2, 3 ORDER BY 1, 2, 3""".format(bucket = BUCKETS[dialect][freq].format('i.date'), status = status_sql(thresholds),
+                                                              clusters = names['clusters'], inventory = names['inventory'],
+                                                              where = ('WHERE ' + ' AND '.join(conditions)) if conditions else '')
+        df = series_frame(fetch(cnx, query, params))
+        return df.set_index(['bucket', 'cluster', 'dock_status'])['snapshots']
+
+
+def ride_series(cluster = None, freq = 'd', start = None, end = None, cnx = None):
+    '''
+    Number of rides starting at the stations of a cluster (or at every
+    clustered station, per cluster, if cluster is None) per freq bucket.
+    '''
+    with connection(cnx) as cnx:
+        dialect = backend(cnx)
+        names = SCHEMAS[dialect]
+        p = names['param']
+        conditions, params = time_filter('r.starttime', start, end, p)
+        if cluster is not None:
+            conditions.insert(0, 'c.cluster = {}'.format(p))
+            params.insert(0, int(cluster))
+        query = """SELECT {bucket} AS bucket, c.cluster, COUNT(*) AS rider_demand
+                   FROM {clusters} c JOIN {rides} r ON r.{station} = c.station_id
+                   {where}
+                   GROUP BY 1, 2 ORDER BY 1, 2""".format(bucket = BUCKETS[dialect][freq].format('r.starttime'), clusters = names['clusters'],
+                                                        rides = names['rides'], station = names['start_station_id'],
+                                                        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else '')
+        df = series_frame(fetch(cnx, query, params))
+        if cluster is not None:
+            return df.set_index('bucket')['rider_demand']
+        return df.set_index(['bucket', 'cluster'])['rider_demand']
+
+
+def cluster_stations(cluster, cnx = None):
+    # Station ids of a cluster
+    with connection(cnx) as cnx:
+        names = SCHEMAS[backend(cnx)]
+        query = "SELECT station_id FROM {} WHERE cluster = {} ORDER BY station_id".format(names['clusters'], names['param'])
+        return fetch(cnx, query, [int(cluster)])['station_id'].tolist()
@@ -0,0 +1,103 @@
+'''
+Single-pass downsampling of the cleaned ride data.
+
+downsampling() in "Models/Downsampling.ipynb" reads and decompresses
+riders_cleaned.csv.gz once per sample. Here the file is streamed once in
+chunks and every sample is drawn from each chunk as it goes by: Bernoulli
+sampling keeps each row with probability fraction, reservoir sampling keeps a
+fixed number of rows per stratum (station, hour and/or month). Every sample
+has its own seeded generator, so samples are independent and reproducible.
+'''
+# Import libraries
+import argparse
+import numpy as np
+import pandas as pd
+from citibike_schema import downcast
+
+IN_CSV = 'riders_cleaned.csv.gz'
+OUT_PARQUET = 'riders_sample.parquet'
+CHUNKSIZE = 500000
+
+RIDER_DTYPES = {'start station id': 'Int32', 'end station id': 'Int32'}
+
+# Column used for each stratification key
+STRATA = {'station': 'start station id',
+          'hour': 'starttime',
+          'month': 'starttime'}
+
+
+def read_riders(path = IN_CSV, chunksize = CHUNKSIZE):
+    # Chunks of the cleaned ride file, typed as in downsampling()
+    for df in pd.read_csv(path, parse_dates = ['starttime', 'stoptime'], dtype = RIDER_DTYPES, chunksize = chunksize):
+        yield df.drop(['Unnamed: 0', 'index'], axis = 1, errors = 'ignore')
+
+
+def strata_keys(df, strata):
+    # Stratum key columns of a chunk, named after the strata
+    keys = pd.DataFrame(index = df.index)
+    for stratum in strata:
+        if stratum not in STRATA:
+            raise ValueError('Unknown stratum: {}'.format(stratum))
+        col = df[STRATA[stratum]]
+        keys['_' + stratum] = col.dt.hour if stratum == 'hour' else col.dt.month if stratum == 'month' else col
+    return keys
+
+
+def bottom_k(df, size, strata):
+    # Rows with the size smallest random keys (of each stratum), i.e. a uniform sample without replacement
+    df = df.sort_values('_key', kind = 'stable')
+    if not strata:
+        return df.head(size)
+    return df.groupby(['_' + stratum for stratum in strata], observed = True, sort = False, dropna = False).head(size)
+
+
+def downsample(chunks, n_samples = 4, fraction = 0.01, size = None, strata = (), seed = 0):
+    '''
+    Draws n_samples independent samples from an iterable of dataframe chunks in
+    a single pass. Without size each row is kept with probability fraction
+    (Bernoulli sampling, like downsampling()). With size a reservoir keeps size
+    rows of every stratum, strata being any of 'station', 'hour' and 'month'.
+    Returns the samples concatenated with a Sample_num column, like downsampling().
+    '''
+    strata = list(strata)
+    rngs = [np.random.default_rng([seed, n]) for n in range(n_samples)]
+    kept = [[] for _ in range(n_samples)]
+
+    n_rows = 0
+    for df in chunks:
+        n_rows += len(df)
+        if size is not None:
+            df = pd.concat([df, strata_keys(df, strata)], axis = 1)
+        for n, rng in enumerate(rngs):
+            keys = rng.random(len(df))
+            if size is None:
+                kept[n].append(df[keys < fraction])
+            else:
+                # The reservoir of the sample so far competes with the new rows
+                candidates = df.assign(_key = keys)
+                kept[n] = [bottom_k(pd.concat(kept[n] + [candidates]), size, strata)]
+        print('{:,} rows read'.format(n_rows))
+
+    samples = []
+    for n in range(n_samples):
+        sample = pd.concat(kept[n])
+        if size is not None:
+            sample = sample.sort_index().drop(['_key'] + ['_' + stratum for stratum in strata], axis = 1)
+        samples.append(sample.assign(Sample_num = np.int8(n)))
+    return downcast(pd.concat(samples, ignore_index = True))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Draw several samples of the cleaned ride data in one pass')
+    parser.add_argument('--csv', default = IN_CSV, help = 'cleaned ride csv file')
+    parser.add_argument('--out', default = OUT_PARQUET, help = 'output parquet file')
+    parser.add_argument('--samples', type = int, default = 4, help = 'number of samples')
+    parser.add_argument('--fraction', type = float, default = 0.01, help = 'probability of keeping a row (Bernoulli sampling)')
+    parser.add_argument('--size', type = int, help = 'rows kept per stratum (reservoir sampling)')
+    parser.add_argument('--strata', nargs = '*', default = [], choices = sorted(STRATA), help = 'stratification keys of reservoir sampling')
+    parser.add_argument('--seed', type = int, default = 0, help = 'random seed')
+    parser.add_argument('--chunksize', type = int, default = CHUNKSIZE, help = 'rows read at a time')
+    args = parser.parse_args()
+    sample_df = downsample(read_riders(args.csv, args.chunksize), args.samples, args.fraction, args.size, args.strata, args.seed)
+    sample_df.to_parquet(args.out, index = False)
+    print('{:,} rows written to {}'.format(len(sample_df), args.out))
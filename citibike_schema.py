@@ -0,0 +1,153 @@
+'''
+Compact in-memory types of the ride and dock inventory data.
+
+Shared by the loaders so every frame uses the same representation: station
+names, user types, statuses and seasons are categoricals (one dictionary of
+station names for all frames), ids and counts are the smallest integer type
+that holds them, coordinates are float32 and the string time column of the
+inventory data is replaced by a real timestamp. memory_report compares the
+bytes per row of a frame before and after conversion.
+'''
+# Import libraries
+import pandas as pd
+
+# 'Unknown' is filled in for missing user types by clean_rider_chunk ("Citibike Database.py")
+USERTYPE = pd.CategoricalDtype(['Subscriber', 'Customer', 'Unknown'])
+DEPLETION_STATUS = pd.CategoricalDtype(['Empty Risk', 'Healthy', 'Full Risk'], ordered = True)
+SEASON = pd.CategoricalDtype(['winter', 'spring', 'summer', 'fall'])
+
+# Types of the canonical ride columns, station names are encoded with STATION_NAMES
+RIDE_DTYPES = {'tripduration': 'int32',
+               'start station id': 'Int32',
+               'start station latitude': 'float32',
+               'start station longitude': 'float32',
+               'end station id': 'Int32',
+               'end station latitude': 'float32',
+               'end station longitude': 'float32',
+               'bikeid': 'Int32',
+               'usertype': USERTYPE,
+               'birth year': 'Int16',
+               'gender': 'int8'}
+
+# Types of the cleaned dock inventory columns (see clean_stationdata_frame)
+INVENTORY_DTYPES = {'dock_id': 'int32',
+                    'hour': 'int8',
+                    'minute': 'int8',
+                    'avail_bikes': 'int16',
+                    'avail_docks': 'int16',
+                    'tot_docks': 'int16',
+                    '_lat': 'float32',
+                    '_long': 'float32',
+                    'in_service': 'int8',
+                    'status_key': 'int8',
+                    'depletion_status': DEPLETION_STATUS,
+                    'dayofweek': 'int8',
+                    'season': SEASON}
+
+RIDE_NAME_COLUMNS = ('start station name', 'end station name')
+INVENTORY_NAME_COLUMNS = ('dock_name',)
+
+
+class CategoryDictionary:
+    '''
+    Growing dictionary of categories shared by several frames. New values are
+    appended, so the code of a value never changes and frames encoded at
+    different times can be aligned to the latest categories cheaply.
+    '''
+    def __init__(self, categories = ()):
+        self.categories = pd.Index(categories, dtype = object)
+
+    def encode(self, values):
+        values = pd.Series(values)
+        new = pd.Index(values.dropna().unique(), dtype = object).difference(self.categories)
+        if len(new):
+            self.categories = self.categories.append(new)
+        return values.astype(pd.CategoricalDtype(self.categories))
+
+    def align(self, series):
+        # Re-encodes a series encoded earlier with the current categories
+        return series.cat.set_categories(self.categories)
+
+
+# Station names of both the ride and the inventory data
+STATION_NAMES = CategoryDictionary()
+
+
+def downcast(df, exclude = ()):
+    '''
+    Downcasts the numeric columns (except the excluded ones, e.g. those typed by
+    the schema) to the smallest type holding their values, and converts repeated
+    strings to categoricals. Returns a new dataframe, df is left unchanged.
+    '''
+    df = df.copy(deep = False)
+    for col in df.columns:
+        if col in exclude:
+            continue
+        if pd.api.types.is_float_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast = 'float')
+        elif pd.api.types.is_integer_dtype(df[col]) and not pd.api.types.is_extension_array_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast = 'integer')
+        elif df[col].dtype == object and df[col].nunique() < len(df) // 2:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def apply_dtypes(df, dtypes, name_columns = (), names = STATION_NAMES):
+    '''
+    Converts the columns of df that are in dtypes, and the station name columns
+    with names. Raises a ValueError if a categorical column holds values that
+    are not categories of its type, instead of silently making them null.
+    Returns a new dataframe, df is left unchanged.
+    '''
+    df = df.copy(deep = False)
+    for col in name_columns:
+        if col in df.columns:
+            df[col] = names.encode(df[col])
+    for col, dtype in dtypes.items():
+        if col in df.columns and df[col].dtype != dtype:
+            if isinstance(dtype, pd.CategoricalDtype):
+                unknown = pd.Index(df[col].dropna().unique()).difference(dtype.categories)
+                if len(unknown):
+                    raise ValueError('Unknown {} values: {}'.format(col, list(unknown)))
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def compact_rides(df):
+    '''
+    Converts a ride dataframe to the compact types. The start and stop times
+    are parsed if they are still strings. df is left unchanged.
+    '''
+    df = df.copy(deep = False)
+    for col in ('starttime', 'stoptime'):
+        if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col])
+    df = apply_dtypes(df, RIDE_DTYPES, RIDE_NAME_COLUMNS)
+    return downcast(df, exclude = RIDE_DTYPES)
+
+
+def compact_inventory(df):
+    '''
+    Converts a cleaned dock inventory dataframe to the compact types, replacing
+    the string time column by a timestamp column (date + hour + minute).
+    df is left unchanged.
+    '''
+    df = df.copy(deep = False)
+    if not pd.api.types.is_datetime64_any_dtype(df['date']):
+        df['date'] = pd.to_datetime(df['date'])
+    df['timestamp'] = df['date'] + pd.to_timedelta(df['hour'].astype('int64') * 60 + df['minute'].astype('int64'), unit = 'min')
+    df = df.drop('time', axis = 1, errors = 'ignore')
+    df = apply_dtypes(df, INVENTORY_DTYPES, INVENTORY_NAME_COLUMNS)
+    return downcast(df, exclude = INVENTORY_DTYPES)
+
+
+def memory_report(before, after):
+    '''
+    Bytes per row of each column of a dataframe before and after conversion to
+    the compact types, with the totals in the last row.
+    '''
+    report = pd.DataFrame({'before': before.memory_usage(index = False, deep = True) / max(len(before), 1),
+                           'after': after.memory_usage(index = False, deep = True) / max(len(after), 1)})
+    report.loc['total'] = report.sum()
+    report['ratio'] = report['before'] / report['after']
+    return report.round(2)
@@ -0,0 +1,260 @@
+'''
+Dock inventory simulator for comparing rebalancing strategies.
+
+Trips are replayed as departures from their start station and arrivals at
+their end station against the capacity (tot_docks) of every station. Events
+are counted per time interval (15 minutes by default) and station in two
+arrays, then the bikes of every station are stepped through the intervals
+with vectorized numpy operations: a departure from an empty station fails
+(an empty event, the trip is cancelled and never arrives) and an arrival at
+a full station is turned away (a full event, the rider tries again in the
+next interval). Within an interval departures are applied before arrivals.
+
+A rebalancing policy is called every few intervals with the current bikes
+and returns the bikes to add to (or remove from) each station. Policies are
+callables, so strategies (thresholds on depletion_status, demand forecasts,
+...) can be compared on the same trips with compare_policies.
+'''
+# Import libraries
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from citibike_storage import read_rides, read_inventory, RIDES_ROOT, INVENTORY_ROOT
+
+INTERVAL = '15min'
+# Intervals between two calls of the rebalancing policy (hourly by default)
+REBALANCE_EVERY = 4
+
+TRIP_COLUMNS = ['starttime', 'stoptime', 'start station id', 'end station id']
+
+
+def load_trips(start, end, root = RIDES_ROOT):
+    # Trips starting in [start, end) from the partitioned rides dataset
+    return read_rides(root, columns = TRIP_COLUMNS, start = start, end = end)
+
+
+def load_docks(start, root = INVENTORY_ROOT):
+    '''
+    Capacity (tot_docks) and bikes (avail_bikes) of every dock at its first
+    snapshot of the day of start, from the partitioned inventory dataset.
+    '''
+    day = pd.Timestamp(start).normalize()
+    snapshots = read_inventory(root, columns = ['dock_id', 'date', 'hour', 'minute', 'avail_bikes', 'tot_docks'],
+                               start = day, end = day + pd.Timedelta(days = 1))
+    snapshots = snapshots.sort_values(['date', 'hour', 'minute']).groupby('dock_id').first()
+    return snapshots['tot_docks'], snapshots['avail_bikes']
+
+
+def event_counts(trips, stations, times):
+    '''
+    Departures and arrivals per interval (rows, starting at each of times) and
+    station (columns, in the order of stations). Trips from or to unknown
+    stations, or starting outside the simulated period, are ignored; trips
+    arriving after its end never arrive. Also returns the interval, station
+    and arrival interval/station of every trip kept, sorted by departure.
+    '''
+    freq = times[1] - times[0]
+    end = times[-1] + freq
+    origin = stations.get_indexer(trips['start station id'])
+    destination = stations.get_indexer(trips['end station id'])
+    kept = (origin >= 0) & (destination >= 0) & (trips['starttime'] >= times[0]).to_numpy() & (trips['starttime'] < end).to_numpy()
+
+    starttime = trips['starttime'].to_numpy()[kept]
+    departure = ((starttime - times[0].to_datetime64()) // freq).astype('int64')
+    arrival = ((trips['stoptime'].to_numpy()[kept] - times[0].to_datetime64()) // freq).astype('int64')
+    # A trip cannot arrive before it leaves
+    arrival = np.maximum(arrival, departure)
+    origin, destination = origin[kept], destination[kept]
+
+    # Trips sorted by departure interval, station and time, so the trips of each (interval, station) are contiguous
+    order = np.lexsort((starttime, origin, departure))
+    departure, origin, arrival, destination = departure[order], origin[order], arrival[order], destination[order]
+
+    n_intervals, n_stations = len(times), len(stations)
+    departures = np.bincount(departure * n_stations + origin, minlength = n_intervals * n_stations)
+    arriving = arrival < n_intervals
+    arrivals = np.bincount(arrival[arriving] * n_stations + destination[arriving], minlength = n_intervals * n_stations)
+    trips = {'departure': departure, 'origin': origin, 'arrival': arrival, 'destination': destination}
+    return departures.reshape(n_intervals, n_stations), arrivals.reshape(n_intervals, n_stations), trips
+
+
+def transfer(surplus, deficit, max_moves = None):
+    '''
+    Moves bikes from the stations with a surplus to the stations with a deficit,
+    largest first, up to max_moves bikes. Returns the bikes added to each
+    station (negative for the stations giving bikes).
+    '''
+    surplus = np.maximum(surplus, 0).astype('int64')
+    deficit = np.maximum(deficit, 0).astype('int64')
+    n_moves = min(surplus.sum(), deficit.sum(), np.inf if max_moves is None else max_moves)
+
+    moves = np.zeros(len(surplus), dtype = 'int64')
+    for amounts, sign in ((surplus, -1), (deficit, 1)):
+        order = np.argsort(-amounts, kind = 'stable')
+        taken = np.diff(np.minimum(np.cumsum(amounts[order]), n_moves), prepend = 0)
+        moves[order] += sign * taken.astype('int64')
+    return moves
+
+
+def no_rebalancing(time, bikes, capacity, stations):
+    return None
+
+
+class ThresholdPolicy:
+    '''
+    Brings the stations below low or above high (as a fraction of tot_docks)
+    back to target, the Empty Risk and Full Risk thresholds of depletion_status
+    by default, moving at most max_moves bikes per call.
+    '''
+    def __init__(self, low = 1/3, high = 2/3, target = 1/2, max_moves = None):
+        self.low = low
+        self.high = high
+        self.target = target
+        self.max_moves = max_moves
+
+    def __call__(self, time, bikes, capacity, stations):
+        target = np.round(capacity * self.target)
+        surplus = np.where(bikes > capacity * self.high, bikes - target, 0)
+        deficit = np.where(bikes < capacity * self.low, target - bikes, 0)
+        return transfer(surplus, deficit, self.max_moves)
+
+
+class ForecastPolicy:
+    '''
+    Rebalances ahead of the forecast demand. forecast is a dataframe indexed by
+    interval start with one column per station id, holding the expected
+    departures minus arrivals of each interval (e.g. from the ride demand
+    model). Over the next horizon, stations expecting a net outflow get the
+    bikes they need and stations expecting a net inflow get free docks for it.
+    '''
+    def __init__(self, forecast, horizon = pd.Timedelta(hours = 2), max_moves = None):
+        self.forecast = forecast.sort_index()
+        self.horizon = pd.Timedelta(horizon)
+        self.max_moves = max_moves
+
+    def __call__(self, time, bikes, capacity, stations):
+        window = self.forecast.loc[time:time + self.horizon - pd.Timedelta(1, 'ns')]
+        net_outflow = window.sum().reindex(stations, fill_value = 0).to_numpy()
+        lower = np.clip(np.ceil(net_outflow), 0, capacity)
+        upper = np.maximum(capacity - np.clip(np.ceil(-net_outflow), 0, capacity), lower)
+        return transfer(bikes - upper, lower - bikes, self.max_moves)
+
+
+class Simulation:
+    '''
+    Bikes at the end of each interval and empty/full events of each interval
+    and station, with the bikes moved by the rebalancing policy. A full event
+    is counted once per turned away arrival, even if the rider waits several
+    intervals for a free dock.
+    '''
+    def __init__(self, times, stations, capacity, bikes, empty, full, moved, seconds):
+        self.times = times
+        self.stations = stations
+        self.capacity = capacity
+        self.bikes = bikes
+        self.empty = empty
+        self.full = full
+        self.moved = moved
+        self.seconds = seconds
+
+    def station_summary(self):
+        # Events and intervals spent empty or full per station
+        return pd.DataFrame({'tot_docks': self.capacity,
+                             'empty_events': self.empty.sum(axis = 0),
+                             'full_events': self.full.sum(axis = 0),
+                             'empty_intervals': (self.bikes == 0).sum(axis = 0),
+                             'full_intervals': (self.bikes == self.capacity).sum(axis = 0)},
+                            index = self.stations)
+
+    def summary(self):
+        return {'empty_events': int(self.empty.sum()),
+                'full_events': int(self.full.sum()),
+                'empty_station_intervals': int((self.bikes == 0).sum()),
+                'full_station_intervals': int((self.bikes == self.capacity).sum()),
+                'bikes_moved': int(self.moved.sum()),
+                'seconds': round(self.seconds, 3)}
+
+
+def simulate(trips, capacity, bikes, start, end, freq = INTERVAL, policy = no_rebalancing, rebalance_every = REBALANCE_EVERY):
+    '''
+    Replays the trips starting in [start, end) against the docks of the
+    stations in capacity (tot_docks per station id), starting from bikes
+    (avail_bikes per station id), and returns a Simulation.
+    '''
+    start_time = time.perf_counter()
+    stations = pd.Index(capacity.index)
+    times = pd.date_range(start, end, freq = freq, inclusive = 'left')
+    departures, arrivals, trips = event_counts(trips, stations, times)
+    # Each interval's trips are a contiguous block of the sorted trips
+    bounds = np.searchsorted(trips['departure'], np.arange(len(times) + 1))
+
+    capacity = capacity.to_numpy(dtype = 'int64')
+    bikes = np.clip(bikes.reindex(stations, fill_value = 0).to_numpy(dtype = 'int64'), 0, capacity)
+    n_intervals, n_stations = departures.shape
+    levels = np.zeros((n_intervals, n_stations), dtype = 'int16')
+    empty = np.zeros((n_intervals, n_stations), dtype = 'int32')
+    full = np.zeros((n_intervals, n_stations), dtype = 'int32')
+    moved = np.zeros(n_intervals, dtype = 'int64')
+    waiting = np.zeros(n_stations, dtype = 'int64')
+
+    for t in range(n_intervals):
+        if t % rebalance_every == 0:
+            moves = policy(times[t], bikes, capacity, stations)
+            if moves is not None:
+                moves = np.clip(moves, -bikes, capacity - bikes)
+                bikes += moves
+                moved[t] = np.abs(moves).sum() // 2
+
+        # Departures from an empty station fail, those trips never arrive
+        served = np.minimum(departures[t], bikes)
+        empty[t] = departures[t] - served
+        bikes -= served
+        if empty[t].any():
+            lo, hi = bounds[t], bounds[t + 1]
+            origin = trips['origin'][lo:hi]
+            # Rank of each trip among the departures of its station in this interval
+            rank = np.arange(hi - lo) - np.searchsorted(origin, origin)
+            cancelled = rank >= served[origin]
+            arrival, destination = trips['arrival'][lo:hi][cancelled], trips['destination'][lo:hi][cancelled]
+            arriving = arrival < n_intervals
+            np.subtract.at(arrivals, (arrival[arriving], destination[arriving]), 1)
+
+        # Arrivals at a full station wait for a free dock in the next interval, riders already waiting dock first
+        arriving = arrivals[t] + waiting
+        docked = np.minimum(arriving, capacity - bikes)
+        full[t] = arrivals[t] - np.maximum(docked - waiting, 0)
+        waiting = arriving - docked
+        bikes += docked
+        levels[t] = bikes
+
+    return Simulation(times, stations, capacity, levels, empty, full, moved, time.perf_counter() - start_time)
+
+
+def compare_policies(trips, capacity, bikes, start, end, policies, freq = INTERVAL, rebalance_every = REBALANCE_EVERY):
+    # Summary of the simulation of each policy (a dict of name: policy) on the same trips
+    results = {}
+    for name, policy in policies.items():
+        results[name] = simulate(trips, capacity, bikes, start, end, freq, policy, rebalance_every).summary()
+        print('{}: {}'.format(name, results[name]))
+    return pd.DataFrame.from_dict(results, orient = 'index')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Replay trips against dock capacity and compare rebalancing policies')
+    parser.add_argument('start', help = 'first day simulated, e.g. 2019-01-01')
+    parser.add_argument('end', help = 'end of the simulated period (excluded), e.g. 2020-01-01')
+    parser.add_argument('--freq', default = INTERVAL, help = 'simulation interval')
+    parser.add_argument('--rebalance-every', type = int, default = REBALANCE_EVERY, help = 'intervals between two rebalancing calls')
+    parser.add_argument('--max-moves', type = int, help = 'bikes moved at most per rebalancing call')
+    parser.add_argument('--out', help = 'csv file for the comparison table')
+    args = parser.parse_args()
+
+    capacity, bikes = load_docks(args.start)
+    trips = load_trips(args.start, args.end)
+    print('{:,} trips, {} stations'.format(len(trips), len(capacity)))
+    policies = {'none': no_rebalancing, 'threshold': ThresholdPolicy(max_moves = args.max_moves)}
+    comparison = compare_policies(trips, capacity, bikes, args.start, args.end, policies, args.freq, args.rebalance_every)
+    print(comparison.to_string())
+    if args.out:
+        comparison.to_csv(args.out)
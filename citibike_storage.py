@@ -0,0 +1,201 @@
+'''
+Columnar storage for the cleaned ride and dock inventory data.
+
+Data is written as Parquet partitioned by year/month (and optionally by station
+cluster) with compact column types, so a reader only touches the months,
+clusters and columns it asks for instead of re-parsing gzip csv files.
+'''
+# Import libraries
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Default locations of the partitioned datasets
+RIDES_ROOT = "../data/parquet/rides"
+INVENTORY_ROOT = "../data/parquet/inventory"
+
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+# Column types of the ride data, columns that are not listed keep their inferred type
+RIDE_TYPES = {'tripduration': pa.int32(),
+              'starttime': pa.timestamp('s'),
+              'stoptime': pa.timestamp('s'),
+              'start station id': pa.int32(),
+              'start station name': CATEGORY,
+              'start station latitude': pa.float32(),
+              'start station longitude': pa.float32(),
+              'end station id': pa.int32(),
+              'end station name': CATEGORY,
+              'end station latitude': pa.float32(),
+              'end station longitude': pa.float32(),
+              'bikeid': pa.int32(),
+              'usertype': CATEGORY,
+              'birth year': pa.int16(),
+              'gender': pa.int8()}
+
+# Column types of the cleaned dock inventory data (see clean_stationdata_frame)
+INVENTORY_TYPES = {'dock_id': pa.int32(),
+                   'dock_name': CATEGORY,
+                   'date': pa.timestamp('s'),
+                   'hour': pa.int8(),
+                   'minute': pa.int8(),
+                   'avail_bikes': pa.int16(),
+                   'avail_docks': pa.int16(),
+                   'tot_docks': pa.int16(),
+                   '_lat': pa.float32(),
+                   '_long': pa.float32(),
+                   'in_service': pa.int8(),
+                   'status_key': pa.int8(),
+                   'depletion_status': CATEGORY,
+                   'time': CATEGORY,
+                   'dayofweek': pa.int8(),
+                   'season': CATEGORY}
+
+# Time and station columns of each dataset, used for partitioning and filtering
+RIDE_KEYS = ('starttime', 'start station id')
+INVENTORY_KEYS = ('date', 'dock_id')
+
+
+def partitioning(by_cluster = False):
+    fields = [pa.field('year', pa.int16()), pa.field('month', pa.int8())]
+    if by_cluster:
+        fields.append(pa.field('cluster', pa.int16()))
+    return ds.partitioning(pa.schema(fields), flavor = 'hive')
+
+
+def to_table(df, types):
+    '''
+    Converts a dataframe to an arrow table using the compact column types.
+    Timestamps are truncated to seconds and floats holding whole numbers
+    (integer columns with missing values) are converted to integers. The cast
+    is checked, so out of range values and floats with a fractional part in an
+    integer column raise an error instead of being written wrapped or truncated.
+    '''
+    fields = []
+    converted = {}
+    for col in df.columns:
+        if col in types:
+            fields.append(pa.field(col, types[col]))
+            if pa.types.is_timestamp(types[col]):
+                converted[col] = pd.to_datetime(df[col]).dt.floor('s')
+            elif pa.types.is_integer(types[col]) and pd.api.types.is_float_dtype(df[col]):
+                # Whole floats are cast by arrow (missing values become nulls), anything else is an error
+                values = df[col].dropna()
+                fractional = values[values != values.round()]
+                if len(fractional):
+                    raise ValueError('Column {} has values with a fractional part, e.g. {}'.format(col, fractional.iloc[0]))
+        else:
+            fields.append(pa.Schema.from_pandas(df[[col]], preserve_index = False).field(col))
+    if converted:
+        df = df.assign(**converted)
+    return pa.Table.from_pandas(df, schema = pa.schema(fields), preserve_index = False, safe = True)
+
+
+def write_partitioned(df, root, types, keys, clusters = None):
+    time_col, station_col = keys
+    times = pd.to_datetime(df[time_col])
+
+    # The partition columns are derived from the timestamp and replace any existing year/month columns
+    df = df.drop(columns = [col for col in ('year', 'month', 'cluster') if col in df.columns])
+    df = df.assign(year = times.dt.year.astype('int16'), month = times.dt.month.astype('int8'))
+    if clusters is not None:
+        df['cluster'] = df[station_col].map(clusters).fillna(-1).astype('int16')
+
+    # Sorting by station and time keeps row group statistics tight for predicate pushdown
+    df = df.sort_values([station_col, time_col])
+
+    ds.write_dataset(to_table(df, types), root, format = 'parquet',
+                     partitioning = partitioning(clusters is not None),
+                     basename_template = 'part-{}-{{i}}.parquet'.format(uuid.uuid4().hex),
+                     existing_data_behavior = 'overwrite_or_ignore')
+    return len(df)
+
+
+def write_rides(df, root = RIDES_ROOT, clusters = None):
+    '''
+    Appends cleaned ride data to the partitioned rides dataset. clusters is an
+    optional mapping of station id -> cluster used as an extra partition level.
+    '''
+    return write_partitioned(df, root, RIDE_TYPES, RIDE_KEYS, clusters)
+
+
+def write_inventory(df, root = INVENTORY_ROOT, clusters = None):
+    '''
+    Appends cleaned dock inventory data to the partitioned inventory dataset.
+    clusters is an optional mapping of dock id -> cluster.
+    '''
+    return write_partitioned(df, root, INVENTORY_TYPES, INVENTORY_KEYS, clusters)
+
+
+def month_filter(start, end):
+    # Partition filter on year/month, used to skip whole directories
+    expr = None
+    if start is not None:
+        start = pd.Timestamp(start)
+        expr = (ds.field('year') > start.year) | ((ds.field('year') == start.year) & (ds.field('month') >= start.month))
+    if end is not None:
+        # end is exclusive, so a range ending at midnight on the 1st does not read that month
+        end = pd.Timestamp(end) - pd.Timedelta(seconds = 1)
+        end_expr = (ds.field('year') < end.year) | ((ds.field('year') == end.year) & (ds.field('month') <= end.month))
+        expr = end_expr if expr is None else expr & end_expr
+    return expr
+
+
+def read_partitioned(root, keys, columns = None, start = None, end = None, stations = None, clusters = None):
+    time_col, station_col = keys
+    by_cluster = clusters is not None
+    dataset = ds.dataset(root, format = 'parquet', partitioning = partitioning(by_cluster))
+
+    # Filters on partition columns prune files, filters on data columns are pushed down to row groups
+    filters = [month_filter(start, end)]
+    if start is not None:
+        filters.append(ds.field(time_col) >= pa.scalar(pd.Timestamp(start), pa.timestamp('s')))
+    if end is not None:
+        filters.append(ds.field(time_col) < pa.scalar(pd.Timestamp(end), pa.timestamp('s')))
+    if stations is not None:
+        filters.append(ds.field(station_col).isin(list(stations)))
+    if by_cluster:
+        filters.append(ds.field('cluster').isin(list(clusters)))
+
+    expr = None
+    for f in filters:
+        if f is not None:
+            expr = f if expr is None else expr & f
+    return dataset.to_table(columns = columns, filter = expr).to_pandas()
+
+
+def read_rides(root = RIDES_ROOT, columns = None, start = None, end = None, stations = None, clusters = None):
+    '''
+    Reads ride data from the partitioned rides dataset. Only the requested
+    columns are read, start (inclusive) and end (exclusive) limit the
+    starttime range, stations limits the start station ids and clusters the
+    station clusters (the dataset must have been written with clusters).
+    '''
+    return read_partitioned(root, RIDE_KEYS, columns, start, end, stations, clusters)
+
+
+def read_inventory(root = INVENTORY_ROOT, columns = None, start = None, end = None, stations = None, clusters = None):
+    '''
+    Reads dock inventory data, see read_rides. stations limits the dock ids.
+    '''
+    return read_partitioned(root, INVENTORY_KEYS, columns, start, end, stations, clusters)
+
+
+def csv_to_parquet(path, kind = 'rides', root = None, clusters = None, chunksize = 1000000):
+    '''
+    Converts a cleaned csv file (e.g. riders_cleaned.csv.gz or stations_cleaned.csv)
+    into the partitioned dataset one chunk at a time. Returns the number of rows written.
+    '''
+    if kind == 'rides':
+        write, parse_dates = write_rides, ['starttime', 'stoptime']
+    else:
+        write, parse_dates = write_inventory, ['date']
+    kwargs = {} if root is None else {'root': root}
+
+    n_rows = 0
+    for chunk in pd.read_csv(path, chunksize = chunksize, parse_dates = parse_dates):
+        chunk = chunk.drop(columns = [col for col in chunk.columns if col.startswith('Unnamed')])
+        n_rows += write(chunk, clusters = clusters, **kwargs)
+        print(f'{n_rows:,} rows written')
+    return n_rows
@@ -0,0 +1,141 @@
+'''
+Per-stage instrumentation of the chunked loading and cleaning loops.
+
+Each stage of a loop (read, clean, insert, ...) is timed with a context
+manager that also counts its rows in and out, and the cleaning functions
+report the rows dropped by each of their rules. Totals are kept per stage
+with the memory high-water mark, and every stage can also be logged as a JSON
+line. Recording a stage costs two clock reads and a getrusage call, so the
+instrumentation stays on in production runs. The resource module does not
+exist on Windows, where the memory high-water mark is reported as missing.
+'''
+# Import libraries
+import sys
+import json
+import time
+import logging
+import pandas as pd
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+logger = logging.getLogger('citibike.telemetry')
+
+
+def max_rss_mb():
+    # Memory high-water mark of the process in MB (ru_maxrss is in bytes on macOS), None without the resource module
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+class Stage:
+    # Rows of one execution of a stage, rows_out is set by the caller
+    def __init__(self, rows_in = None):
+        self.rows_in = rows_in
+        self.rows_out = None
+
+
+class Telemetry:
+    '''
+    Collects the wall time, rows in/out and memory high-water mark of each
+    stage, and the rows dropped by each cleaning rule.
+
+        with telemetry.stage('clean', rows_in = len(chunk)) as stage:
+            chunk = clean(chunk)
+            stage.rows_out = len(chunk)
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.dropped = {}
+
+    def stage(self, name, rows_in = None):
+        return StageTimer(self, name, rows_in)
+
+    def record(self, name, seconds, rows_in, rows_out):
+        rss = max_rss_mb()
+        totals = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0, 'max_rss_mb': None if rss is None else 0.0})
+        totals['calls'] += 1
+        totals['seconds'] += seconds
+        totals['rows_in'] += rows_in or 0
+        totals['rows_out'] += rows_out or 0
+        if rss is not None:
+            totals['max_rss_mb'] = max(totals['max_rss_mb'], rss)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({'stage': name, 'seconds': round(seconds, 6), 'rows_in': rows_in,
+                                    'rows_out': rows_out, 'max_rss_mb': None if rss is None else round(rss, 1)}))
+
+    def drop(self, rule, rows):
+        # Counts the rows removed (or failing) a cleaning rule
+        rows = int(rows)
+        self.dropped[rule] = self.dropped.get(rule, 0) + rows
+        if rows and logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({'rule': rule, 'dropped': rows}))
+
+    def iterate(self, chunks, name = 'read'):
+        '''
+        Yields the chunks of an iterator (e.g. a chunked read_csv), timing the
+        production of each chunk as the name stage.
+        '''
+        chunks = iter(chunks)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start_time, None, len(chunk))
+            yield chunk
+
+    def summary(self):
+        # Table of the stage totals with their throughput, and of the rows dropped by each rule
+        stages = pd.DataFrame.from_dict(self.stages, orient = 'index')
+        if len(stages):
+            stages['rows_per_sec'] = (stages[['rows_in', 'rows_out']].max(axis = 1) / stages['seconds'].clip(lower = 1e-9)).round(1)
+            stages['seconds'] = stages['seconds'].round(3)
+            stages['max_rss_mb'] = pd.to_numeric(stages['max_rss_mb']).round(1)
+        dropped = pd.Series(self.dropped, name = 'dropped', dtype = 'int64')
+        return stages, dropped
+
+    def report(self):
+        stages, dropped = self.summary()
+        if len(stages):
+            print(stages.to_string())
+        if len(dropped):
+            print(dropped.to_string())
+
+    def reset(self):
+        self.stages = {}
+        self.dropped = {}
+
+
+class StageTimer:
+    def __init__(self, telemetry, name, rows_in):
+        self.telemetry = telemetry
+        self.name = name
+        self.stage = Stage(rows_in)
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self.stage
+
+    def __exit__(self, *exc):
+        self.telemetry.record(self.name, time.perf_counter() - self.start_time, self.stage.rows_in, self.stage.rows_out)
+        return False
+
+
+def log_json(stream = None):
+    '''
+    Writes every stage and dropped row count as a JSON line to stream (stderr
+    by default), in addition to the totals kept for the summary.
+    '''
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return handler
+
+
+# Default collector shared by the loading and cleaning modules
+telemetry = Telemetry()
@@ -0,0 +1,151 @@
+'''
+Successive halving search for the ride demand random forest.
+
+run_model in "Models/Rider Demand CV" fits 100 random candidates with up to
+2000 trees on 3 shuffled folds each. Here every candidate starts with a few
+trees and only the best third of the candidates is refit with three times
+as many trees at each round, up to 2000 trees, on folds that always
+validate on hours after the ones they train on. The feature and target
+matrices are cached as .npy files, keyed by a fingerprint of the input files
+and of the code building them, and memory-mapped on later runs, so a re-run
+skips the feature construction.
+'''
+# Import libraries
+import os
+import json
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import HalvingRandomSearchCV, TimeSeriesSplit
+from citibike_aggregates import fingerprint, CACHE_DIR
+
+# Search space of run_model, without n_estimators which is the resource of the halving rounds.
+# max_features 'auto' of the regressor meant all the features, i.e. 1.0.
+PARAM_DISTRIBUTIONS = {'max_features': [1.0, 'sqrt'],
+                       'max_depth': [int(x) for x in np.linspace(10, 110, num = 11)] + [None],
+                       'min_samples_split': [2, 5, 10],
+                       'min_samples_leaf': [1, 2, 4],
+                       'bootstrap': [True, False]}
+MAX_TREES = 2000
+
+
+def code_version(*objects):
+    '''
+    Hash of the source code of functions or modules (of their bytecode when the
+    source is not available), so a cache key changes with the code.
+    '''
+    digest = hashlib.sha1()
+    for obj in objects:
+        try:
+            digest.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            digest.update(obj.__code__.co_code + repr(obj.__code__.co_consts).encode())
+    return digest.hexdigest()[:16]
+
+
+def cached_matrices(sources, build, cache_dir = CACHE_DIR, version = None):
+    '''
+    Returns the feature matrix, target vector, row timestamps and column names
+    built by build() from the files in sources. build returns a features
+    dataframe and a target series whose first index level is the timestamp.
+    Rows are sorted by time and text columns are replaced by integer codes.
+    The arrays are saved as .npy files under a key fingerprinting the sources,
+    the source code of build and version, and returned memory-mapped, so a
+    cache hit reads nothing up front. version stands for the rest of the code
+    the features depend on, e.g. code_version of the feature functions.
+    '''
+    build_key = hashlib.sha1('{}:{}'.format(code_version(build), version).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, 'matrices-{}-{}'.format(fingerprint(sources), build_key))
+    if not os.path.exists(os.path.join(path, 'columns.json')):
+        features, target = build()
+        times = pd.DatetimeIndex(features.index.get_level_values(0)).values
+        order = np.argsort(times, kind = 'stable')
+
+        columns, categories, values = [], {}, []
+        for col in features.columns:
+            series = features[col]
+            if not pd.api.types.is_numeric_dtype(series):
+                codes, uniques = pd.factorize(series)
+                series = pd.Series(codes, index = features.index)
+                categories[col] = [str(value) for value in uniques]
+            columns.append(col)
+            values.append(series.to_numpy(dtype = np.float32)[order])
+
+        os.makedirs(path, exist_ok = True)
+        np.save(os.path.join(path, 'X.npy'), np.column_stack(values))
+        np.save(os.path.join(path, 'y.npy'), np.asarray(target, dtype = np.float64)[order])
+        np.save(os.path.join(path, 'times.npy'), times[order].astype('int64'))
+        # The column file is written last, so an interrupted build is rebuilt on the next run
+        with open(os.path.join(path, 'columns.json'), 'w') as f:
+            json.dump({'columns': columns, 'categories': categories}, f)
+
+    with open(os.path.join(path, 'columns.json')) as f:
+        columns = json.load(f)['columns']
+    X = np.load(os.path.join(path, 'X.npy'), mmap_mode = 'r')
+    y = np.load(os.path.join(path, 'y.npy'), mmap_mode = 'r')
+    times = np.load(os.path.join(path, 'times.npy'), mmap_mode = 'r').view('datetime64[ns]')
+    return X, y, times, columns
+
+
+def time_split(times, test_size = 0.3):
+    # Index of the first test row: the last test_size of the (sorted) hours are held out
+    hours = np.unique(times)
+    return int(np.searchsorted(times, hours[int(len(hours) * (1 - test_size))]))
+
+
+def time_folds(times, n_splits = 3):
+    '''
+    Expanding window folds over sorted row timestamps: each fold trains on the
+    hours before its validation hours, and rows of the same hour always fall
+    in the same side of a split.
+    '''
+    hours = np.unique(times)
+    starts = np.searchsorted(times, hours)
+    ends = np.append(starts[1:], len(times))
+    folds = []
+    for train, test in TimeSeriesSplit(n_splits = n_splits).split(hours):
+        folds.append((np.arange(ends[train[-1]]), np.arange(starts[test[0]], ends[test[-1]])))
+    return folds
+
+
+def halving_search(X, y, folds, param_distributions = PARAM_DISTRIBUTIONS, n_candidates = 100, max_trees = MAX_TREES,
+                   factor = 3, random_state = 42, n_jobs = -1):
+    '''
+    Successive halving search over random forests, using the number of trees
+    as the resource: the n_candidates candidates start with the fewest trees
+    that let the last round reach max_trees, and each round keeps the best
+    1/factor of them. The best candidate is refit on all of X with max_trees.
+    '''
+    search = HalvingRandomSearchCV(RandomForestRegressor(random_state = random_state),
+                                   param_distributions, n_candidates = n_candidates, factor = factor,
+                                   resource = 'n_estimators', max_resources = max_trees, min_resources = 'exhaust',
+                                   cv = folds, random_state = random_state, n_jobs = n_jobs, verbose = 1)
+    search.fit(X, y)
+    return search
+
+
+def search_results(search):
+    '''
+    One row per candidate and round with its number of trees, mean score and
+    fit time. fit_seconds is the total time spent fitting it on every fold.
+    '''
+    cv_results = pd.DataFrame(search.cv_results_)
+    results = pd.DataFrame({'iter': cv_results['iter'],
+                            'n_trees': cv_results['n_resources'],
+                            'mean_fit_time': cv_results['mean_fit_time'],
+                            'fit_seconds': cv_results['mean_fit_time'] * search.n_splits_,
+                            'mean_test_score': cv_results['mean_test_score'],
+                            'rank_test_score': cv_results['rank_test_score']})
+    return pd.concat([results, pd.DataFrame(list(cv_results['params'])).drop(columns = 'n_estimators')], axis = 1)
+
+
+def evaluate_search(search, X_test, y_test):
+    # Same results as evaluate_model, timed with the single refit of the best candidate
+    predictions = search.best_estimator_.predict(X_test)
+    errors = abs(predictions - y_test)
+    mape = 100 * np.mean(errors / y_test)
+    return {'time': search.refit_time_, 'error': np.mean(errors), 'accuracy': 100 - mape,
+            'n_trees': search.best_estimator_.get_params()['n_estimators'], 'n_features': X_test.shape[1]}
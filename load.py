@@ -1,7 +1,9 @@
 import pandas as pd
 import sqlite3
-from pandas.io import sql
-import subprocess
+import argparse
+import time
+import os
+from citibike_telemetry import telemetry, log_json
 
 # In and output file paths
 in_csv = 'all_combined.csv'
@@ -13,27 +15,104 @@ chunksize = 300000 # number of lines to process at each iteration
 # columns that should be read from the CSV file
 columns = ['tripduration','starttime','stoptime','start station id','start station name','start station latitude','start station longitude','end station id','end station name','end station latitude','end station longitude','bikeid','usertype','birth year','gender']
 
-# Get number of lines in the CSV file
-nlines = subprocess.check_output(['wc', '-l', in_csv])
-nlines = int(nlines.split()[0]) 
-
-# connect to database
-cnx = sqlite3.connect(out_sqlite)
-
-# Iteratively read CSV and dump lines into the SQLite table
-for i in range(0, nlines, chunksize):  # change 0 -> 1 if your csv file contains a column header
-    
-    df = pd.read_csv(in_csv,  
-            header=None,  # no header, define column header manually later
-            nrows=chunksize, # number of rows to read at each iteration
-            skiprows=i)   # skip rows that were already read
-    
-    # columns to read        
-    df.columns = columns
-
-    sql.to_sql(df, 
-                name=table_name, 
-                con=cnx, 
-                index=False, # don't use CSV file index
-                if_exists='append') 
-cnx.close()    
\ No newline at end of file
+# SQLite column types for the rides table (type affinity converts numeric text on insert)
+column_types = ['INTEGER','TEXT','TEXT','INTEGER','TEXT','REAL','REAL','INTEGER','TEXT','REAL','REAL','INTEGER','TEXT','INTEGER','INTEGER']
+
+# Pragmas for bulk loading. The database is rebuilt from the CSV files if a load fails,
+# so durability is traded for speed: no fsync and the rollback journal is kept in memory.
+bulk_pragmas = ['PRAGMA journal_mode = MEMORY',
+                'PRAGMA synchronous = OFF',
+                'PRAGMA temp_store = MEMORY',
+                'PRAGMA cache_size = -500000', # ~500MB page cache
+                'PRAGMA locking_mode = EXCLUSIVE']
+
+# SQL script that refreshes the station dimension from the rows loaded since its last run
+stations_sql = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'citibike_sql')
+
+
+def has_header(path):
+    '''
+    Checks whether the first line of the csv file is a column header
+    (the merge scripts copy the header of the first monthly file)
+    '''
+    with open(path, 'r', encoding = 'utf-8') as f:
+        first_field = f.readline().split(',')[0].strip().strip('"')
+    return not first_field.isnumeric()
+
+
+def create_table(cnx, name = table_name):
+    schema = ", ".join('"{}" {}'.format(col, col_type) for col, col_type in zip(columns, column_types))
+    cnx.execute('CREATE TABLE IF NOT EXISTS "{}" ({})'.format(name, schema))
+    cnx.commit()
+
+
+def refresh_stations(cnx):
+    '''
+    Upserts the stations of the newly loaded rides into the stations table and
+    creates the station/starttime indexes of the rides table (see citibike_sql)
+    '''
+    with open(stations_sql, 'r') as f:
+        cnx.executescript(f.read())
+
+
+def load_csv(path = in_csv, database = out_sqlite, name = table_name, batch_size = chunksize, refresh = True):
+    '''
+    Streams the combined ride csv into SQLite in a single pass. Each batch of
+    rows is inserted with executemany inside its own transaction and the load
+    rate is printed after every batch. The station dimension is refreshed
+    incrementally once the load is done. Returns the number of rows loaded.
+    '''
+    cnx = sqlite3.connect(database)
+    for pragma in bulk_pragmas:
+        cnx.execute(pragma)
+    create_table(cnx, name)
+
+    insert_stmt = 'INSERT INTO "{}" VALUES ({})'.format(name, ", ".join(["?" for _ in columns]))
+
+    # A single reader streams through the file once, batch_size rows at a time
+    reader = pd.read_csv(path,
+            header = 0 if has_header(path) else None,
+            names = columns,
+            chunksize = batch_size)
+
+    n_rows = 0
+    start_time = time.time()
+    for df in telemetry.iterate(reader, 'load: read'):
+        with telemetry.stage('load: convert', rows_in = len(df)) as stage:
+            # The merge scripts can copy the header of a monthly file into the middle of the csv
+            header_rows = df[columns[0]].astype(str) == columns[0]
+            if header_rows.any():
+                telemetry.drop('load: embedded header', header_rows.sum())
+                df = df[~header_rows]
+            # Missing values must be inserted as NULL rather than NaN
+            df = df.astype(object).where(df.notna(), None)
+            stage.rows_out = len(df)
+        with telemetry.stage('load: insert', rows_in = len(df)) as stage:
+            with cnx: # commits the batch, or rolls it back on error
+                cnx.executemany(insert_stmt, df.itertuples(index = False, name = None))
+            stage.rows_out = len(df)
+        n_rows += len(df)
+        elapsed = time.time() - start_time
+        print('{:,} rows loaded ({:,.0f} rows/sec)'.format(n_rows, n_rows / max(elapsed, 1e-9)))
+
+    # The stations script reads the allrides table
+    if refresh and name == table_name:
+        with telemetry.stage('load: refresh stations'):
+            refresh_stations(cnx)
+    cnx.close()
+    return n_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Load the combined ride csv into SQLite')
+    parser.add_argument('--csv', default = in_csv, help = 'combined ride csv file')
+    parser.add_argument('--sqlite', default = out_sqlite, help = 'output SQLite database')
+    parser.add_argument('--table', default = table_name, help = 'name of the rides table')
+    parser.add_argument('--chunksize', type = int, default = chunksize, help = 'rows per insert batch')
+    parser.add_argument('--no-refresh', action = 'store_true', help = 'do not refresh the stations table after the load')
+    parser.add_argument('--log-json', action = 'store_true', help = 'log every stage as a JSON line on stderr')
+    args = parser.parse_args()
+    if args.log_json:
+        log_json()
+    load_csv(args.csv, args.sqlite, args.table, args.chunksize, refresh = not args.no_refresh)
+    telemetry.report()
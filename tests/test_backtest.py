@@ -0,0 +1,48 @@
+'''
+walk_forward against the per-step ARIMA loop of model_creation in the time
+series notebooks, on a one-column dataframe as the notebooks pass it.
+'''
+# Import libraries
+import os
+import sys
+import warnings
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.arima.model import ARIMA
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from citibike_backtest import walk_forward
+
+
+def reference_walk_forward(df):
+    # model_creation of the notebooks without the printing
+    X = df.values
+    size = int(len(X) * 0.66)
+    train, test = X[0:size], X[size:len(X)]
+    history = [x for x in train]
+    predictions = list()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for t in range(len(test)):
+            demand_fit = ARIMA(history, order = (5, 1, 0)).fit()
+            predictions.append(demand_fit.forecast()[0])
+            history.append(test[t])
+    rmse = np.sqrt(np.mean((test.ravel() - np.array(predictions)) ** 2))
+    return np.array(predictions), test.ravel(), rmse
+
+
+def test_walk_forward_matches_notebook_loop():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'rides': np.cumsum(rng.normal(size = 90))})
+
+    expected_predictions, expected_test, expected_rmse = reference_walk_forward(df)
+    _, predictions, test, rmse = walk_forward(df, refit_every = 1)
+
+    assert predictions.shape == test.shape == expected_test.shape
+    np.testing.assert_array_equal(test, expected_test)
+    np.testing.assert_allclose(predictions, expected_predictions, atol = 1e-2)
+    assert abs(rmse - expected_rmse) < 1e-2
+
+    # Without refits the parameters of the training fit are kept, the error stays of the same size
+    _, _, _, rmse = walk_forward(df)
+    assert rmse < 2 * expected_rmse
@@ -0,0 +1,126 @@
+'''
+Equivalence test of the vectorized cleaning_stationdata against the original
+row by row implementation, on a synthetic fixture of raw station snapshots.
+'''
+# Import libraries
+import os
+import re
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from citibike_functions import cleaning_stationdata, clean_stationdata_frame, read_stations_cleaned
+
+
+def reference_cleaning_stationdata(df, out):
+    '''
+    cleaning_stationdata before it was vectorized, with the output path as a
+    parameter and the chained assignment of the pm hours written with .loc
+    (a chained assignment does not modify the frame under copy-on-write).
+    '''
+    df.dropna(inplace = True)
+    df.drop(df[df['dock_id'].apply(lambda x: isinstance(x, str))].index, inplace = True)
+    df = df[df['tot_docks'] < 500]
+
+    mask = ~df['avail_bikes'].astype(str).str.contains('[A-z]')
+    df = df[mask]
+    df['avail_bikes'] = df['avail_bikes'].apply(lambda x: re.sub("\"", "", str(x)))
+    df = df[df['avail_bikes'] != ""]
+    df['avail_bikes'] = df['avail_bikes'].astype(float).astype(int)
+    df = df[df['avail_bikes'] <= 200]
+
+    mask = ~df['avail_docks'].astype(str).str.contains('[A-z]')
+    df = df[mask]
+    df['avail_docks'] = df['avail_docks'].apply(lambda x: re.sub("\"", "", str(x)))
+    df = df[df['avail_docks'] != ""]
+    df['avail_docks'] = df['avail_docks'].astype(float).astype(int)
+    df = df[df['avail_docks'] <= 200]
+
+    df['date'] = pd.to_datetime(df['date'], format = '"%y-%m-%d"')
+
+    df['dock_id'] = df['dock_id'].astype(int)
+    df['tot_docks'] = df['tot_docks'].astype(int)
+    df['minute'] = df['minute'].astype(int)
+
+    df['_lat'] = df['_lat'].apply(lambda x: float(re.sub('\"', "", str(x))))
+    df['_long'] = df['_long'].apply(lambda x: re.sub('[^-^.0-9]', "", str(x))).apply(lambda x: re.sub("-{2}", "-", str(x)))
+    df = df[df['_long'] != ""]
+    df['_long'].astype(float)
+
+    df['hour'] = df['hour'].apply(lambda x: re.sub('[^0-9]', "", str(x))).astype(int)
+    df.loc[df['pm'] == 1, 'hour'] = df.loc[df['pm'] == 1, 'hour'] + 12
+
+    df['dock_name'] = df['dock_name'].apply(lambda x: str(re.sub('\"', "", x)))
+
+    df['depletion_status'] = (df['avail_bikes']/df['tot_docks']).apply(lambda x: "Full Risk" if x > 2/3 else "Empty Risk" if x < 1/3 else "Healthy")
+
+    df.drop(['pm'], axis = 1, inplace = True)
+
+    df = df.assign(time = lambda x: x['hour'].astype(str) + ":" + x['minute'].astype(str))
+    df = df.assign(dayofweek = lambda x: x['date'].dt.weekday)
+    df = df.assign(\
+        season = lambda x: x['date'].dt.month.apply(\
+        lambda y: 'winter' if y <= 2 else 'spring' if y <= 5 else 'summer' if y <= 8 else 'fall' if y <= 11 else 'winter'))
+
+    df.to_csv(out, index = False)
+
+
+def station_fixture(n_rows = 2000, seed = 0):
+    '''
+    Raw station snapshots as the merged station files hold them: quoted dates,
+    names, counts and coordinates, with missing values, counts containing
+    letters, impossible numbers of bikes/docks and too many total docks.
+    Hours run from 1 to 11: 12 AM/PM are converted differently since the
+    hour fix of clean_stationdata_frame, so they are left out of the fixture.
+    '''
+    rng = np.random.default_rng(seed)
+    tot_docks = rng.integers(10, 60, n_rows)
+    avail_bikes = rng.integers(0, 60, n_rows)
+    df = pd.DataFrame({'dock_id': rng.integers(72, 3500, n_rows),
+                       'dock_name': ['"Station {}"'.format(i) for i in rng.integers(0, 50, n_rows)],
+                       'date': ['"{:02d}-{:02d}-{:02d}"'.format(y, m, d) for y, m, d in
+                                zip(rng.integers(13, 20, n_rows), rng.integers(1, 13, n_rows), rng.integers(1, 29, n_rows))],
+                       'hour': ['"{}"'.format(h) for h in rng.integers(1, 12, n_rows)],
+                       'minute': rng.integers(0, 60, n_rows),
+                       'pm': rng.integers(0, 2, n_rows),
+                       'avail_bikes': ['"{}"'.format(b) for b in avail_bikes],
+                       'avail_docks': ['"{}"'.format(d) for d in np.maximum(tot_docks - avail_bikes, 0)],
+                       'tot_docks': tot_docks,
+                       '_lat': ['"{}"'.format(round(x, 5)) for x in rng.uniform(40.6, 40.8, n_rows)],
+                       '_long': ['"{}"'.format(round(x, 5)) for x in rng.uniform(-74.05, -73.9, n_rows)],
+                       'in_service': 1,
+                       'status_key': 1})
+
+    # Corrupted rows
+    rows = rng.choice(n_rows, 200, replace = False)
+    df.loc[rows[:40], 'avail_bikes'] = '"4a"'
+    df.loc[rows[40:80], 'avail_docks'] = '"x"'
+    df.loc[rows[80:120], 'avail_bikes'] = '"250"'
+    df.loc[rows[120:160], 'tot_docks'] = 900
+    df.loc[rows[160:200], 'dock_name'] = np.nan
+    return df
+
+
+def test_cleaning_stationdata_matches_reference(tmp_path):
+    df = station_fixture()
+    reference_cleaning_stationdata(df.copy(), tmp_path / 'reference.csv')
+    cleaning_stationdata(df.copy(), tmp_path / 'vectorized.csv')
+
+    reference = (tmp_path / 'reference.csv').read_text()
+    vectorized = (tmp_path / 'vectorized.csv').read_text()
+    assert reference.count('\n') > 1000
+    assert vectorized == reference
+
+
+def test_cleaned_frames_are_compact(tmp_path):
+    df = station_fixture()
+    compact = cleaning_stationdata(df.copy(), tmp_path / 'stations_cleaned.csv')
+    loaded = read_stations_cleaned(tmp_path / 'stations_cleaned.csv')
+
+    for frame in (compact, clean_stationdata_frame(df.copy()), loaded):
+        assert 'time' not in frame.columns
+        assert frame['hour'].dtype == 'int8'
+        assert isinstance(frame['depletion_status'].dtype, pd.CategoricalDtype)
+        assert frame['timestamp'].equals(frame['date'] + pd.to_timedelta(frame['hour'].astype(int) * 60 + frame['minute'].astype(int), unit = 'min'))
+    pd.testing.assert_frame_equal(loaded, compact.reset_index(drop = True), check_exact = False)
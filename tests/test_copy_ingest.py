@@ -0,0 +1,90 @@
+'''
+Resume and checkpoint tests of copy_ingest on the SQLite fallback.
+'''
+# Import libraries
+import os
+import sys
+import sqlite3
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from citibike_copy import copy_ingest
+
+
+def create_databases(path, source, n_rows = 1000):
+    # Raw table keyed by row_id, with its rows inserted in a different order than the key, and the clean table
+    cnx = sqlite3.connect(source)
+    cnx.execute('CREATE TABLE raw (row_id INTEGER PRIMARY KEY, dock_id INTEGER, avail_bikes INTEGER)')
+    rows = [(i, i % 37, i % 11) for i in range(1, n_rows + 1)]
+    cnx.executemany('INSERT INTO raw VALUES (?, ?, ?)', rows[::2] + rows[1::2])
+    cnx.commit()
+    cnx.close()
+    cnx = sqlite3.connect(path)
+    cnx.execute('CREATE TABLE clean (dock_id INTEGER, avail_bikes INTEGER)')
+    cnx.commit()
+    cnx.close()
+
+
+def loaded(path, query = 'SELECT dock_id, avail_bikes FROM clean ORDER BY dock_id, avail_bikes'):
+    cnx = sqlite3.connect(path)
+    df = pd.read_sql(query, cnx)
+    cnx.close()
+    return df
+
+
+def checkpoints(path):
+    return loaded(path, 'SELECT * FROM load_checkpoint')
+
+
+class Failure(Exception):
+    pass
+
+
+def test_resume_on_key(tmp_path):
+    path, source = str(tmp_path / 'citibike.sqlite'), str(tmp_path / 'raw.sqlite')
+    create_databases(path, source)
+
+    def chunks(last_row_id):
+        cnx = sqlite3.connect(source)
+        return pd.read_sql('SELECT * FROM raw WHERE row_id > ? ORDER BY row_id', cnx, params = (last_row_id or 0,), chunksize = 100)
+
+    def failing_clean(chunk):
+        if chunk['row_id'].min() > 300:
+            raise Failure()
+        return chunk[['dock_id', 'avail_bikes']]
+
+    with pytest.raises(Failure):
+        copy_ingest(chunks, 'clean', failing_clean, key = 'row_id', database = path)
+    assert len(loaded(path)) == 300
+    assert checkpoints(path)['position'].tolist() == [300]
+
+    # The resumed run loads every remaining row once and clears the checkpoint
+    copy_ingest(chunks, 'clean', lambda chunk: chunk[['dock_id', 'avail_bikes']], key = 'row_id', database = path)
+    expected = loaded(source, 'SELECT dock_id, avail_bikes FROM raw ORDER BY dock_id, avail_bikes')
+    pd.testing.assert_frame_equal(loaded(path), expected)
+    assert len(checkpoints(path)) == 0
+
+    # A later run starts a new load instead of skipping everything
+    copy_ingest(chunks, 'clean', lambda chunk: chunk[['dock_id', 'avail_bikes']], key = 'row_id', database = path)
+    assert len(loaded(path)) == 2 * len(expected)
+
+
+def test_resume_on_chunk_index(tmp_path):
+    path = str(tmp_path / 'citibike.sqlite')
+    create_databases(path, str(tmp_path / 'raw.sqlite'))
+    frames = [pd.DataFrame({'dock_id': range(i * 10, i * 10 + 10), 'avail_bikes': i}) for i in range(5)]
+
+    def failing_chunks():
+        for i, frame in enumerate(frames):
+            if i == 3:
+                raise Failure()
+            yield frame
+
+    with pytest.raises(Failure):
+        copy_ingest(failing_chunks(), 'clean', database = path)
+    assert checkpoints(path)['position'].tolist() == [2]
+
+    copy_ingest(iter(frames), 'clean', database = path)
+    pd.testing.assert_frame_equal(loaded(path), pd.concat(frames, ignore_index = True))
+    assert len(checkpoints(path)) == 0
@@ -0,0 +1,38 @@
+'''
+Station ids of the monthly trip files.
+'''
+# Import libraries
+import os
+import sys
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from citibike_ingest import station_ids, normalize_trips, DECIMAL_ID_OFFSET
+from citibike_telemetry import telemetry
+
+
+def test_station_ids():
+    values = pd.Series(['72', ' 5329.03 ', '6140.05', 'JC013', 'Lab - NYC', None], name = 'start station id')
+    dropped = telemetry.dropped.get('ingest: unresolved start station id', 0)
+    ids = station_ids(values, lookup = {'JC013': 3183})
+    assert ids.tolist()[:4] == [72, DECIMAL_ID_OFFSET + 532903, DECIMAL_ID_OFFSET + 614005, 3183]
+    assert ids[4:].isna().all()
+    # The unresolved id is counted, the missing one is not
+    assert telemetry.dropped['ingest: unresolved start station id'] - dropped == 1
+
+
+def test_normalize_trips_keeps_the_2021_station_ids():
+    df = pd.DataFrame({'ride_id': ['A', 'B', 'started_at'],
+                       'started_at': ['2021-03-01 08:00:00', '2021-03-01 08:05:00', 'started_at'],
+                       'ended_at': ['2021-03-01 08:10:00', '2021-03-01 08:25:00', 'ended_at'],
+                       'start_station_id': ['5329.03', '72', 'start_station_id'],
+                       'end_station_id': ['6140.05', 'JC013', 'end_station_id'],
+                       'member_casual': ['member', 'casual', 'member_casual']})
+    for col in ('start_station_name', 'end_station_name', 'start_lat', 'start_lng', 'end_lat', 'end_lng'):
+        df[col] = ['1', '1', col]
+    rides = normalize_trips(df, station_lookup = {'JC013': 3183})
+    # The embedded header line is dropped, the station ids are kept
+    assert rides['start station id'].tolist() == [DECIMAL_ID_OFFSET + 532903, 72]
+    assert rides['end station id'].tolist() == [DECIMAL_ID_OFFSET + 614005, 3183]
+    assert rides['usertype'].tolist() == ['Subscriber', 'Customer']
+    assert rides['tripduration'].tolist() == [600, 1200]
@@ -0,0 +1,82 @@
+'''
+Streaming merge of the monthly trip files against a concat of the parsed files.
+'''
+# Import libraries
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from citibike_ingest import normalize_trips, RIDE_COLUMNS
+from citibike_merge import merge_trip_files
+
+
+def old_rows(n, seed):
+    # Rows of a 2013 - 2020 trip file as strings
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2019-01-01') + pd.to_timedelta(np.sort(rng.integers(0, 86400 * 28, n)), unit = 's')
+    duration = rng.integers(60, 3600, n)
+    return pd.DataFrame({'tripduration': duration,
+                         'starttime': start.strftime('%Y-%m-%d %H:%M:%S'),
+                         'stoptime': (start + pd.to_timedelta(duration, unit = 's')).strftime('%Y-%m-%d %H:%M:%S'),
+                         'start station id': rng.integers(72, 4000, n),
+                         'start station name': ['W {} St, Manhattan'.format(i) for i in rng.integers(1, 200, n)],
+                         'start station latitude': np.round(rng.uniform(40.6, 40.8, n), 6),
+                         'start station longitude': np.round(rng.uniform(-74.05, -73.9, n), 6),
+                         'end station id': rng.integers(72, 4000, n),
+                         'end station name': ['E {} St'.format(i) for i in rng.integers(1, 200, n)],
+                         'end station latitude': np.round(rng.uniform(40.6, 40.8, n), 6),
+                         'end station longitude': np.round(rng.uniform(-74.05, -73.9, n), 6),
+                         'bikeid': rng.integers(14000, 35000, n),
+                         'usertype': rng.choice(['Subscriber', 'Customer'], n),
+                         'birth year': rng.integers(1940, 2002, n),
+                         'gender': rng.integers(0, 3, n)}).astype(str)
+
+
+def new_rows(n, seed):
+    # Rows of a 2021 trip file (decimal station ids, member_casual)
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2021-03-01') + pd.to_timedelta(np.sort(rng.integers(0, 86400 * 28, n)), unit = 's')
+    return pd.DataFrame({'ride_id': ['R{}'.format(i) for i in range(n)],
+                         'rideable_type': 'classic_bike',
+                         'started_at': start.strftime('%Y-%m-%d %H:%M:%S'),
+                         'ended_at': (start + pd.to_timedelta(rng.integers(60, 3600, n), unit = 's')).strftime('%Y-%m-%d %H:%M:%S'),
+                         'start_station_name': 'Broadway & W 58 St',
+                         'start_station_id': ['{:.2f}'.format(x) for x in rng.integers(300000, 800000, n) / 100],
+                         'end_station_name': '8 Ave & W 31 St',
+                         'end_station_id': rng.integers(72, 4000, n).astype(str),
+                         'start_lat': '40.766953', 'start_lng': '-73.981693', 'end_lat': '40.750585', 'end_lng': '-73.994685',
+                         'member_casual': rng.choice(['member', 'casual'], n)})
+
+
+def write_trip_file(path, df, header_every = None, quoted = False, final_newline = True):
+    # Writes a trip file, with the header repeated every header_every rows like a cat of monthly files
+    lines = []
+    for start in range(0, len(df), header_every or len(df)):
+        part = df.iloc[start:start + (header_every or len(df))]
+        lines.append(part.to_csv(index = False, header = start == 0 or header_every is not None,
+                                 quoting = 1 if quoted else 0, lineterminator = '\n'))
+    text = ''.join(lines)
+    path.write_text(text if final_newline else text.rstrip('\n'))
+
+
+def test_merge_matches_concat(tmp_path):
+    files = [tmp_path / '201901-citibike-tripdata.csv', tmp_path / '201902-citibike-tripdata.csv',
+             tmp_path / '202103-citibike-tripdata.csv']
+    write_trip_file(files[0], old_rows(700, 0), header_every = 250)
+    write_trip_file(files[1], old_rows(500, 1), quoted = True, final_newline = False)
+    write_trip_file(files[2], new_rows(400, 2))
+
+    merged = tmp_path / 'merged.csv'
+    # A small block size puts block boundaries inside rows and header lines
+    merge_trip_files([str(f) for f in files], str(merged), blocksize = 4096, chunksize = 150)
+
+    result = pd.read_csv(merged, dtype = str)
+    assert list(result.columns) == RIDE_COLUMNS
+    assert len(result) == 700 + 500 + 400
+
+    # The old way: every file parsed on its own (embedded headers dropped) and concatenated
+    expected = pd.concat([normalize_trips(pd.read_csv(f, dtype = str)) for f in files], ignore_index = True)
+    assert len(expected) == len(result)
+    pd.testing.assert_frame_equal(normalize_trips(result).reset_index(drop = True), expected)
@@ -0,0 +1,68 @@
+'''
+Origin-destination flow matrices against a groupby of the rides.
+'''
+# Import libraries
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from citibike_od import FlowMatrices
+
+
+def rides(n, stations, month, seed):
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(month) + pd.to_timedelta(rng.integers(0, 28 * 86400, n), unit = 's')
+    return pd.DataFrame({'starttime': start,
+                         'start station id': rng.choice(stations, n).astype(float),
+                         'end station id': rng.choice(stations, n).astype(float)})
+
+
+def selected(df, day_type = None, hour = None):
+    # Rides of a day type and hour
+    times = pd.DatetimeIndex(df['starttime'])
+    mask = np.ones(len(df), dtype = bool)
+    if day_type is not None:
+        mask &= (times.dayofweek >= 5) == (day_type == 'weekend')
+    if hour is not None:
+        mask &= times.hour == hour
+    return df[mask]
+
+
+def flows_frame(flows, day_type = None, hour = None):
+    frame = flows.frame(day_type, hour)
+    return frame.set_index(['start station id', 'end station id'])['rides'].sort_index()
+
+
+def test_flows_match_groupby_when_stations_are_added(tmp_path):
+    january = rides(2000, [72, 79, 82, 83], '2019-01-01', 0)
+    january.loc[:9, 'end station id'] = np.nan
+    # February has new stations, so the matrices are resized
+    february = rides(2000, [72, 79, 3000, 3001, 3002], '2019-02-01', 1)
+
+    flows = FlowMatrices()
+    assert flows.add(january, label = '2019-01') == 1990
+    assert flows.matrix().shape == (4, 4)
+    assert flows.add(february, label = '2019-02') == 2000
+    assert flows.add(february, label = '2019-02') == 0
+    assert flows.matrix().shape == (7, 7)
+
+    both = pd.concat([january, february]).dropna()
+    for day_type, hour in ((None, None), ('weekday', 8), ('weekend', 17)):
+        subset = selected(both, day_type, hour)
+        expected = subset.groupby(['start station id', 'end station id']).size()
+        result = flows_frame(flows, day_type, hour)
+        np.testing.assert_array_equal(result.index.to_frame().to_numpy(), expected.index.to_frame().to_numpy())
+        np.testing.assert_array_equal(result.to_numpy(), expected.to_numpy())
+
+        net = subset.groupby('end station id').size().sub(subset.groupby('start station id').size(), fill_value = 0)
+        net = net.reindex(flows.station_ids, fill_value = 0)
+        np.testing.assert_array_equal(flows.net_inflow(day_type, hour).to_numpy(), net.to_numpy())
+
+    # Saved and loaded matrices keep the station order and the labels
+    flows.save(str(tmp_path))
+    loaded = FlowMatrices.load(str(tmp_path))
+    assert loaded.labels == {'2019-01', '2019-02'}
+    assert (loaded.matrix() != flows.matrix()).nnz == 0
+    np.testing.assert_array_equal(loaded.station_ids, flows.station_ids)
@@ -0,0 +1,84 @@
+'''
+SQLite tests of the cluster series of citibike_query against a pandas groupby.
+'''
+# Import libraries
+import os
+import sys
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import load
+from citibike_query import inventory_series, inventory_by_cluster, ride_series, store_clusters
+
+
+@pytest.fixture
+def database(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 3000
+    clusters = pd.DataFrame({'station_id': np.arange(1, 41), 'cluster': np.arange(40) % 3})
+    # Counts exactly at the 3/10 and 7/10 thresholds are included
+    tot_docks = rng.choice([10, 20, 30], n)
+    inventory = pd.DataFrame({'dock_id': rng.integers(1, 46, n),
+                              'date': (pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 30 * 24 * 60, n), unit = 'min')).astype(str),
+                              'avail_bikes': np.minimum(rng.integers(0, 11, n) * tot_docks // 10, tot_docks),
+                              'tot_docks': tot_docks})
+    rides = pd.DataFrame({'start station id': rng.integers(1, 46, n),
+                          'starttime': (pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 30 * 24 * 3600, n), unit = 's')).astype(str)})
+
+    cnx = sqlite3.connect(str(tmp_path / 'citibike.sqlite'))
+    inventory.to_sql('inventory', cnx, index = False)
+    load.create_table(cnx)
+    rides.to_sql('allrides', cnx, index = False, if_exists = 'append')
+    store_clusters(cnx, clusters)
+    yield cnx, clusters, inventory, rides
+    cnx.close()
+
+
+def notebook_inventory(inventory, clusters):
+    # daily_inventory of "Time Series of Dock Status.ipynb", with dock_status of stationdata_cleaning.ipynb
+    df = inventory.merge(clusters, left_on = 'dock_id', right_on = 'station_id')
+    df['dock_status'] = (df['avail_bikes']/df['tot_docks']).apply(lambda x: "Full Alert" if x > 7/10 else "Empty Alert" if x < 3/10 else "Healthy")
+    df = df.set_index(pd.to_datetime(df['date']))
+    return df.groupby([pd.Grouper(freq = 'd'), 'cluster', 'dock_status'])['date'].count()
+
+
+def test_inventory_series_matches_groupby(database):
+    cnx, clusters, inventory, _ = database
+    daily_inventory = notebook_inventory(inventory, clusters)
+
+    for cluster in range(3):
+        for status in ('Empty Alert', 'Full Alert', 'Healthy'):
+            expected = daily_inventory[pd.IndexSlice[:, cluster, status]]
+            series = inventory_series(cluster, status, cnx = cnx)
+            np.testing.assert_array_equal(series.index, expected.index)
+            np.testing.assert_array_equal(series.to_numpy(), expected.to_numpy())
+
+    by_cluster = inventory_by_cluster(cnx = cnx)
+    assert by_cluster.sum() == daily_inventory.sum()
+
+    # A label is never counted with the thresholds of another status column
+    with pytest.raises(ValueError):
+        inventory_series(0, 'Empty Risk', cnx = cnx)
+    risk = inventory_series(0, 'Empty Risk', cnx = cnx, thresholds = (1/3, 2/3))
+    assert risk.sum() > inventory_series(0, 'empty', cnx = cnx).sum()
+
+
+def test_ride_series_matches_groupby(database):
+    cnx, clusters, _, rides = database
+    df = rides.merge(clusters, left_on = 'start station id', right_on = 'station_id')
+    df = df.set_index(pd.to_datetime(df['starttime']))
+    expected = df.groupby([pd.Grouper(freq = 'H'), 'cluster']).size()
+
+    series = ride_series(freq = 'H', cnx = cnx)
+    np.testing.assert_array_equal(series.index.get_level_values(0), expected.index.get_level_values(0))
+    np.testing.assert_array_equal(series.index.get_level_values(1), expected.index.get_level_values(1))
+    np.testing.assert_array_equal(series.to_numpy(), expected.to_numpy())
+
+    start, end = '2019-01-05', '2019-01-12'
+    one = ride_series(1, freq = 'd', start = start, end = end, cnx = cnx)
+    expected = df[(df.index >= start) & (df.index < end) & (df['cluster'] == 1)].groupby(pd.Grouper(freq = 'd')).size()
+    np.testing.assert_array_equal(one.to_numpy(), expected.to_numpy())
+    np.testing.assert_array_equal(one.index, expected.index)
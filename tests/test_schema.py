@@ -0,0 +1,33 @@
+'''
+Compact types of the ride data.
+'''
+# Import libraries
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from citibike_schema import compact_rides
+
+
+def rides():
+    return pd.DataFrame({'tripduration': [600, 700, 800],
+                         'starttime': ['2019-01-01 00:00:00', '2019-01-01 00:05:00', '2019-01-01 00:07:00'],
+                         'start station id': [72, 79, 72],
+                         'usertype': ['Subscriber', 'Customer', 'Unknown'],
+                         'gender': [1, 2, 0]})
+
+
+def test_compact_rides_leaves_the_input_unchanged():
+    df = rides()
+    before = df.copy()
+    compact = compact_rides(df)
+    pd.testing.assert_frame_equal(df, before)
+    assert compact['usertype'].tolist() == ['Subscriber', 'Customer', 'Unknown']
+    assert compact['tripduration'].dtype == 'int32'
+
+
+def test_unknown_user_types_raise():
+    with pytest.raises(ValueError):
+        compact_rides(rides().assign(usertype = ['Subscriber', 'Customer', 'nan']))
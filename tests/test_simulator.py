@@ -0,0 +1,56 @@
+'''
+Dock inventory simulator on a hand-built list of trips.
+'''
+# Import libraries
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from citibike_simulator import simulate, ThresholdPolicy
+
+START, END = '2019-07-01 08:00', '2019-07-01 09:00'
+
+
+def trips(rows):
+    df = pd.DataFrame(rows, columns = ['starttime', 'stoptime', 'start station id', 'end station id'])
+    df['starttime'] = pd.to_datetime('2019-07-01 ' + df['starttime'])
+    df['stoptime'] = pd.to_datetime('2019-07-01 ' + df['stoptime'])
+    return df
+
+
+def test_empty_and_full_events():
+    # Station 1 has 2 docks and 1 bike, station 2 has 1 dock and 1 bike (full)
+    capacity = pd.Series([2, 1], index = [1, 2])
+    bikes = pd.Series([1, 1], index = [1, 2])
+    rides = trips([('08:01', '08:05', 1, 2),  # leaves station 1, turned away at the full station 2 until a dock frees up
+                   ('08:02', '08:20', 1, 2),  # station 1 is empty: cancelled, never arrives
+                   ('08:16', '08:40', 2, 1),  # frees the dock of station 2 for the waiting rider, docks at station 1
+                   ('08:30', '08:31', 3, 1)]) # unknown station, ignored
+    sim = simulate(rides, capacity, bikes, START, END)
+
+    assert sim.empty.sum(axis = 0).tolist() == [1, 0]
+    assert sim.full.sum(axis = 0).tolist() == [0, 1]
+    assert sim.bikes.tolist() == [[0, 1], [0, 1], [1, 1], [1, 1]]
+    # Every bike is docked again at the end, none was created or lost
+    assert sim.bikes[-1].sum() == bikes.sum()
+    summary = sim.summary()
+    assert (summary['empty_events'], summary['full_events'], summary['bikes_moved']) == (1, 1, 0)
+
+
+def test_rebalancing_conserves_bikes():
+    rng = np.random.default_rng(0)
+    stations = np.arange(1, 21)
+    capacity = pd.Series(rng.integers(5, 20, len(stations)), index = stations)
+    bikes = pd.Series(rng.integers(0, 5, len(stations)), index = stations)
+    starts = pd.Timestamp(START) + pd.to_timedelta(rng.integers(0, 40 * 60, 300), unit = 's')
+    rides = pd.DataFrame({'starttime': starts, 'stoptime': starts + pd.Timedelta(minutes = 5),
+                          'start station id': rng.choice(stations, 300), 'end station id': rng.choice(stations, 300)})
+
+    for policy in (None, ThresholdPolicy()):
+        sim = simulate(rides, capacity, bikes, START, END, **({} if policy is None else {'policy': policy}))
+        # Every trip ends at least 15 minutes before the end of the period, so the bikes at the end are the bikes at the start
+        assert sim.bikes[-1].sum() == bikes.sum()
+        assert (sim.bikes >= 0).all() and (sim.bikes <= capacity.to_numpy()).all()
+    assert sim.moved.sum() > 0
@@ -0,0 +1,38 @@
+'''
+Type conversion of the partitioned Parquet datasets.
+'''
+# Import libraries
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from citibike_storage import to_table, write_rides, read_rides, RIDE_TYPES
+
+
+def rides():
+    return pd.DataFrame({'tripduration': [600, 700],
+                         'starttime': pd.to_datetime(['2019-01-01 00:00:00.500', '2019-02-01 08:00:01.000']),
+                         'start station id': [72.0, np.nan],
+                         'gender': [1, 2],
+                         'birth year': [1980.0, np.nan]})
+
+
+def test_whole_floats_and_timestamps_are_converted(tmp_path):
+    table = to_table(rides(), RIDE_TYPES)
+    assert table.schema.field('start station id').type == pa.int32()
+    assert table.column('start station id').to_pylist() == [72, None]
+    assert table.column('starttime').to_pylist()[0] == pd.Timestamp('2019-01-01 00:00:00')
+
+    write_rides(rides(), str(tmp_path))
+    assert len(read_rides(str(tmp_path))) == 2
+
+
+def test_unsafe_values_raise():
+    with pytest.raises(ValueError):
+        to_table(rides().assign(**{'birth year': [1980.5, np.nan]}), RIDE_TYPES)
+    with pytest.raises(pa.ArrowInvalid):
+        to_table(rides().assign(gender = [1, 300]), RIDE_TYPES)
@@ -0,0 +1,50 @@
+'''
+Time ordered folds and the matrix cache of the ride demand search.
+'''
+# Import libraries
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from citibike_tuning import cached_matrices, time_split, time_folds
+
+
+def hourly_times(n_hours = 200, seed = 0):
+    # Sorted row timestamps with several stations (rows) per hour
+    rng = np.random.default_rng(seed)
+    hours = pd.date_range('2019-01-01', periods = n_hours, freq = 'h').values
+    return np.sort(np.repeat(hours, rng.integers(1, 6, n_hours)))
+
+
+def test_folds_validate_after_training():
+    times = hourly_times()
+    folds = time_folds(times, n_splits = 3)
+    assert len(folds) == 3
+    for train, test in folds:
+        assert times[train].max() < times[test].min()
+        # Every row of a validation hour is in the validation rows
+        assert len(test) == np.isin(times, np.unique(times[test])).sum()
+
+    split = time_split(times, test_size = 0.3)
+    assert times[:split].max() < times[split:].min()
+    assert abs(len(np.unique(times[split:])) - 0.3 * len(np.unique(times))) <= 1
+
+
+def test_matrices_are_rebuilt_when_the_build_changes(tmp_path):
+    source = tmp_path / 'model_data.csv'
+    source.write_text('x\n1\n')
+    times = pd.date_range('2019-01-01', periods = 4, freq = 'h')
+    calls = []
+
+    def build():
+        calls.append(1)
+        return pd.DataFrame({'hour': times.hour}, index = times), pd.Series(np.arange(4.0), index = times)
+
+    X, _, _, columns = cached_matrices([str(source)], build, cache_dir = str(tmp_path), version = 1)
+    cached_matrices([str(source)], build, cache_dir = str(tmp_path), version = 1)
+    assert len(calls) == 1 and columns == ['hour']
+
+    cached_matrices([str(source)], build, cache_dir = str(tmp_path), version = 2)
+    assert len(calls) == 2